@@ -0,0 +1,94 @@
+
+import re
+import sys
+import time
+from typing import Callable, Optional
+
+try:  # libxml2 tokenizer when available (QGIS usually ships lxml)
+    from lxml import etree as _lxml
+except ImportError:
+    _lxml = None
+
+if _lxml is not None and _lxml.LXML_VERSION >= (5, 0):
+    ET = _lxml
+    # resolve_entities=False would leave "&#38;" in attribute values seen by a parser
+    # target; "internal" (lxml >= 5) expands &amp; etc. but still never loads external ones.
+    # huge_tree stays off: libxml2's size/depth limits guard against hostile documents.
+    _PARSER_KW = {"resolve_entities": "internal", "no_network": True, "huge_tree": False, "collect_ids": False}
+else:
+    from xml.etree import ElementTree as ET
+    _PARSER_KW = {}
+
+from .net_utils import http_stream
+
+_CAPS_TIMEOUT_MS = 15000
+
+# EPSG code in any of "EPSG:3857", "urn:ogc:def:crs:EPSG:6.3:3857", ".../def/crs/EPSG/0/3857"
+_EPSG_RE = re.compile(r"EPSG(?:[:/][\d.]*(?=[:/]))?[^0-9]{0,4}(\d{3,6})(?!\d)", re.IGNORECASE)
+# code -> sys.intern("EPSG:code"); the same few strings repeat on every layer
+_EPSG_INTERN = {}
+
+
+def epsg_authid(crs: str) -> str:
+    """
+    Interned 'EPSG:nnnn' for any EPSG spelling (URN/OGC forms included), else ''.
+    Layer CRS lists and the dialog's CRS set then share the same few string objects.
+    """
+    m = _EPSG_RE.search(crs) if crs else None
+    if not m:
+        return ""
+    code = m.group(1)
+    authid = _EPSG_INTERN.get(code)
+    if authid is None:
+        authid = _EPSG_INTERN[code] = sys.intern(f"EPSG:{code}")
+    return authid
+
+
+def stream_parse(
+    url: str, target, cancelled: Optional[Callable[[], bool]] = None, force_refresh: bool = False,
+):
+    """
+    Download a capabilities document and parse it while it arrives (64 KB chunks
+    from net_utils.http_stream straight into an XMLParser driving 'target'), in a
+    single pass. Returns (target.close() result, final URL); raises ET.ParseError
+    or RuntimeError.
+    'cancelled' is polled before every chunk; once it returns True the reply is
+    aborted and RuntimeError("Cancelled") raised. 'force_refresh' skips the
+    conditional request against the disk cache (see http_stream).
+    """
+    parser = ET.XMLParser(target=target, **_PARSER_KW)
+    feed = parser.feed
+    if cancelled is not None:
+        def feed(chunk: bytes) -> None:
+            if cancelled():
+                raise RuntimeError("Cancelled")  # http_stream aborts the reply
+            parser.feed(chunk)
+
+    final_url = http_stream(url, feed, timeout_ms=_CAPS_TIMEOUT_MS, force_refresh=force_refresh)
+    return parser.close(), final_url
+
+
+class CapsCache:
+    """Parsed capabilities kept in memory for 'ttl' seconds per key."""
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._entries = {}  # key -> (expires_at, value)
+
+    def get(self, key):
+        hit = self._entries.get(key)
+        if hit is None:
+            return None
+        if time.monotonic() >= hit[0]:
+            self._entries.pop(key, None)
+            return None
+        return hit[1]
+
+    def put(self, key, value) -> None:
+        self._entries[key] = (time.monotonic() + self._ttl, value)
+
+    def pop(self, key) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -1,11 +1,50 @@
 
-from typing import Dict, Optional, Tuple, List, Literal
+from enum import Enum
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, NamedTuple, Optional, Tuple, List, Literal
 
 ServiceType = Literal["WMS", "WMTS", "REST"]
 
 
-# CATALOG[country][region] -> {"type": <ServiceType>, "url": <str>}
-CATALOG: Dict[str, Dict[str, Dict[str, str]]] = {
+class ServiceKind(str, Enum):
+    """
+    Normalized service type. Subclasses str, so members still compare equal to
+    "WMS"/"WMTS"/"REST" and work anywhere a plain type string is expected.
+    """
+    WMS = "WMS"
+    WMTS = "WMTS"
+    REST = "REST"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+class Entry(NamedTuple):
+    """
+    Immutable catalog entry. entry["type"], entry.get("url") and "type" in entry
+    still work for older callers.
+    """
+    type: ServiceKind
+    url: str
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self._fields:
+                return getattr(self, key)
+            raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+    def __contains__(self, key) -> bool:
+        # dict semantics: membership tests the keys, not the values
+        return key in self._fields
+
+
+# Source table: [country][region] -> {"type": <ServiceType>, "url": <str>}.
+# Packed into _ENTRIES below and then dropped; CATALOG is rebuilt on demand.
+_SOURCE: Dict[str, Dict[str, Dict[str, str]]] = {
     "Belgium": {
         "All": {"type": "WMS", "url": "https://wms.ngi.be/inspire/ortho/service"},
     },
@@ -131,28 +170,112 @@ CATALOG: Dict[str, Dict[str, Dict[str, str]]] = {
 }
 
 
+# One (country, region, kind, url) row per entry; "type" is normalized once here.
+_Row = Tuple[str, str, ServiceKind, str]
+_ENTRIES: Tuple[_Row, ...] = tuple(
+    (country, region, ServiceKind(entry["type"].strip().upper()), entry["url"])
+    for country, regions in _SOURCE.items()
+    for region, entry in regions.items()
+)
+del _SOURCE
+
+# (country, region) -> Entry, so get_entry is a single hash lookup with no allocation at all.
+_BY_PAIR: Dict[Tuple[str, str], Entry] = {
+    (country, region): Entry(kind, url) for country, region, kind, url in _ENTRIES
+}
+
+# Sorted views computed once; the catalog is static after import.
+_SORTED_COUNTRIES: Tuple[str, ...] = tuple(sorted({row[0] for row in _ENTRIES}))
+_SORTED_REGIONS: Dict[str, Tuple[str, ...]] = {
+    country: tuple(sorted(row[1] for row in _ENTRIES if row[0] == country))
+    for country in _SORTED_COUNTRIES
+}
+
+
+def _build_trie() -> Dict[str, Any]:
+    """
+    Character trie over lowercased "country/region" keys, plus the bare region
+    name so regions can be found without typing the country first.
+    A node's None key holds the (country, region) pairs ending there.
+    """
+    root: Dict[str, Any] = {}
+    for country, region, _, _ in _ENTRIES:
+        keys = [f"{country}/{region}".lower()]
+        if region != "All":
+            keys.append(region.lower())
+        for key in keys:
+            node = root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, []).append((country, region))
+    return root
+
+
+_TRIE: Dict[str, Any] = _build_trie()
+
+
 # ---------- Helper API ---------- #
 
-def get_entry(country: str, region: str = "All") -> Optional[Dict[str, str]]:
+def get_entry(country: str, region: str = "All") -> Optional[Entry]:
     """
-    Return {"type": <ServiceType>, "url": <str>} for the given country/region,
+    Return Entry(type=<ServiceKind>, url=<str>) for the given country/region,
     or None if not found.
     """
-    return CATALOG.get(country, {}).get(region)
+    return _BY_PAIR.get((country, region))
 
 
 def list_countries() -> List[str]:
     """Sorted list of available countries."""
-    return sorted(CATALOG.keys())
+    return list(_SORTED_COUNTRIES)
 
 
 def list_regions(country: str) -> List[str]:
     """Sorted list of regions for a country."""
-    return sorted(CATALOG.get(country, {}).keys())
+    return list(_SORTED_REGIONS.get(country, ()))
 
 
-# If older code expects a flat mapping (country -> region -> url), expose it read-only.
-COUNTRY_WMS: Dict[str, Dict[str, str]] = {
-    country: {region: entry["url"] for region, entry in regions.items()}
-    for country, regions in CATALOG.items()
-}
+def prefix_search(prefix: str, limit: int = 20) -> List[Tuple[str, str]]:
+    """
+    (country, region) pairs whose "country/region" or region name starts with
+    'prefix' (case-insensitive), alphabetically, at most 'limit' results.
+    """
+    node = _TRIE
+    for ch in (prefix or "").lower():
+        node = node.get(ch)
+        if node is None:
+            return []
+
+    out: List[Tuple[str, str]] = []
+    seen = set()
+    stack = [node]
+    while stack and len(out) < limit:
+        cur = stack.pop()
+        for pair in cur.get(None, ()):
+            if pair not in seen:
+                seen.add(pair)
+                out.append(pair)
+        # push children reversed so the DFS pops them in alphabetical order
+        stack.extend(cur[ch] for ch in sorted((k for k in cur if k is not None), reverse=True))
+    return out[:limit]
+
+
+# ---------- Legacy nested views (built on first access) ---------- #
+
+def __getattr__(name: str):
+    """
+    Lazily materialize the read-only nested mappings older code imports:
+      CATALOG[country][region] -> Entry(type=<ServiceKind>, url=<str>)
+      COUNTRY_WMS[country][region] -> url
+    """
+    nested: Dict[str, Dict[str, Any]] = {}
+    if name == "CATALOG":
+        for (country, region), entry in _BY_PAIR.items():
+            nested.setdefault(country, {})[region] = entry
+    elif name == "COUNTRY_WMS":
+        for country, region, _, url in _ENTRIES:
+            nested.setdefault(country, {})[region] = url
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value: Mapping = MappingProxyType({c: MappingProxyType(rs) for c, rs in nested.items()})
+    globals()[name] = value
+    return value
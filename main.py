@@ -1,31 +1,82 @@
+import re
+from types import SimpleNamespace
 
 from PyQt5.QtWidgets import QAction, QMessageBox
 from PyQt5.QtGui import QIcon
-from PyQt5.QtCore import Qt   
+from PyQt5.QtCore import QTimer, QSettings, QThreadPool, QObject, QRunnable, pyqtSignal
 from qgis.core import QgsProject
-from qgis.utils import iface
 
-from .ui import EuropeOrthoDialog
-from .wms_utils import load_wms_layers, add_wms_layer
+from .catalog import ServiceKind
 
 
-try:
-    from .wmts_utils import load_wmts_layers, add_wmts_layer
-except Exception:  
-    def load_wmts_layers(url, tree_widget):
-        raise NotImplementedError("WMTS support not yet installed.")
-
-    def add_wmts_layer(layer_identifier, wmts_link, matrix_set=None, fmt=None):
-        raise NotImplementedError("WMTS support not yet installed.")
-
-try:
-    from .rest_utils import load_rest_layers, add_rest_layer
-except Exception:  
-    def load_rest_layers(url, tree_widget):
-        raise NotImplementedError("ArcGIS REST support not yet installed.")
+def _import_service_handlers() -> SimpleNamespace:
+    """
+    Import the dialog and the WMS/WMTS/REST modules on first use.
+    Keeps QGIS startup cheap: nothing heavy is loaded until the toolbar button is clicked.
+    """
+    from .ui import EuropeOrthoDialog
+    from .net_utils import warm_cache
+    from .wms_utils import (
+        load_wms_layers, fetch_wms_layers, add_wms_layer, get_capabilities_url as wms_capabilities_url,
+        is_cached as wms_is_cached, clear_caches as clear_wms_caches,
+    )
+
+    try:
+        from .wmts_utils import (
+            load_wmts_layers, fetch_wmts_layers, add_wmts_layer, get_capabilities_url as wmts_capabilities_url,
+            is_cached as wmts_is_cached, clear_caches as clear_wmts_caches,
+        )
+    except Exception:  
+        fetch_wmts_layers = None  # listing falls back to load_wmts_layers on the UI thread
+
+        def load_wmts_layers(url, model):
+            raise NotImplementedError("WMTS support not yet installed.")
+
+        def add_wmts_layer(layer_identifier, wmts_link, matrix_set=None, fmt=None, payload=None):
+            raise NotImplementedError("WMTS support not yet installed.")
+
+        def wmts_capabilities_url(url):
+            return None
+
+        def wmts_is_cached(url):
+            return False
+
+        def clear_wmts_caches():
+            pass
+
+    try:
+        from .rest_utils import load_rest_layers, fetch_rest_layers, add_rest_layer, clear_caches as clear_rest_caches
+    except Exception:  
+        fetch_rest_layers = None
+
+        def load_rest_layers(url, model):
+            raise NotImplementedError("ArcGIS REST support not yet installed.")
+
+        def add_rest_layer(service_url, layer_identifier, fmt=None, where=None, time_params=None, service_info=None):
+            raise NotImplementedError("ArcGIS REST support not yet installed.")
+
+        def clear_rest_caches():
+            pass
+
+    return SimpleNamespace(
+        EuropeOrthoDialog=EuropeOrthoDialog,
+        warm_cache=warm_cache,
+        load_wms_layers=load_wms_layers,
+        fetch_wms_layers=fetch_wms_layers,
+        add_wms_layer=add_wms_layer,
+        wms_capabilities_url=wms_capabilities_url,
+        wms_is_cached=wms_is_cached,
+        clear_caches=(clear_wms_caches, clear_wmts_caches, clear_rest_caches),
+        load_wmts_layers=load_wmts_layers,
+        fetch_wmts_layers=fetch_wmts_layers,
+        add_wmts_layer=add_wmts_layer,
+        wmts_capabilities_url=wmts_capabilities_url,
+        wmts_is_cached=wmts_is_cached,
+        load_rest_layers=load_rest_layers,
+        fetch_rest_layers=fetch_rest_layers,
+        add_rest_layer=add_rest_layer,
+    )
 
-    def add_rest_layer(service_url, layer_identifier, fmt=None, where=None, time_params=None):
-        raise NotImplementedError("ArcGIS REST support not yet installed.")
 
 # Catalog
 try:
@@ -33,23 +84,80 @@ try:
 except Exception:
     get_entry = None
 
+# Values accepted from an explicit service-type selector in the dialog
+_SELECTOR_TYPES = frozenset({"WMS", "WMTS", "REST", "ARCGIS REST", "ARCGIS_REST"})
+
+_REST_URL_RE = re.compile(r"/mapserver|/featureserver|/rest/services/", re.IGNORECASE)
+_WMTS_URL_RE = re.compile(r"service=wmts|\{tilematrix\}|tilematrixset=|/wmts/", re.IGNORECASE)
+
+_SETTINGS_RECENT = "EuropeOrthoWMS/recentServices"  # MRU list of "TYPE|url"
+_RECENT_MAX = 3
+_PREFETCH_TIMEOUT_MS = 3000
 
-def detect_service_type(url: str) -> str:
+
+def detect_service_type(url: str) -> ServiceKind:
     """
     Heuristic detection from URL.
-    Returns: 'WMS' | 'WMTS' | 'REST'
+    Returns: ServiceKind.WMS | ServiceKind.WMTS | ServiceKind.REST
     """
     if not url:
-        return "WMS"
+        return ServiceKind.WMS
+
+    if _REST_URL_RE.search(url):
+        return ServiceKind.REST
+    if _WMTS_URL_RE.search(url):
+        return ServiceKind.WMTS
 
-    u = url.lower()
+    return ServiceKind.WMS
+
+
+class _FetchLayersSignals(QObject):
+    """Created on the UI thread, so connected slots run there (queued)."""
+    finished = pyqtSignal(object)   # fetch_*_layers result (plain Python data, no widgets)
+    failed = pyqtSignal(str)        # error text
+
+
+class _FetchLayersTask(QRunnable):
+    """
+    Run one fetch_*_layers(url, cancelled=...) call (download + parse) on a QThreadPool worker.
+    The layer list model is only filled on the UI thread, from the emitted result.
+    The capabilities prefetch reuses it with warm_cache and a list of URLs.
+
+    Keep a Python reference to the task until one of its signals has fired.
+    """
+
+    def __init__(self, fetch, url: str, **fetch_kwargs):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.fetch = fetch
+        self.url = url
+        self.fetch_kwargs = fetch_kwargs
+        self.signals = _FetchLayersSignals()
+        self._cancelled = False
+
+    def cancel(self) -> None:
+        """
+        Drop the result and stop the download: fetch() polls is_cancelled before
+        every chunk and aborts the reply (a stalled one still waits for the
+        transfer timeout, which only measures inactivity).
+        """
+        self._cancelled = True
 
-    if "/mapserver" in u or "/featureserver" in u or "/rest/services/" in u:
-        return "REST"
-    if "service=wmts" in u or "{tilematrix}" in u or "tilematrixset=" in u or "/wmts/" in u:
-        return "WMTS"
+    def is_cancelled(self) -> bool:
+        return self._cancelled
 
-    return "WMS"
+    def run(self) -> None:
+        try:
+            result, error = self.fetch(self.url, cancelled=self.is_cancelled, **self.fetch_kwargs), None
+        except Exception as e:  # never let an exception escape a pool thread
+            result, error = None, str(e)
+
+        if self._cancelled:
+            return
+        if error is not None:
+            self.signals.failed.emit(error)
+        else:
+            self.signals.finished.emit(result)
 
 
 class EuropeOrthoWMSPlugin:
@@ -57,6 +165,12 @@ class EuropeOrthoWMSPlugin:
         self.iface = iface_
         self.dlg = None
         self.action = None
+        self._svc = None  # lazily imported handlers, see _services()
+        self._list_dispatch = {}
+        self._add_dispatch = {}
+        self._fetch_dispatch = {}
+        self._fetcher = None  # in-flight _FetchLayersTask, if any
+        self._prefetcher = None  # in-flight cache revalidation task, if any
 
     def initGui(self):
         self.action = QAction(
@@ -69,24 +183,76 @@ class EuropeOrthoWMSPlugin:
         self.iface.addPluginToMenu("&EuropeOrthoWMS", self.action)
 
     def unload(self):
+        self._cancel_fetch()
+        if self._prefetcher is not None:
+            self._prefetcher.cancel()
         if self.action:
             self.iface.removeToolBarIcon(self.action)
             self.iface.removePluginMenu("&EuropeOrthoWMS", self.action)
 
     def run(self):
         if self.dlg is None:
-            self.dlg = EuropeOrthoDialog(self.iface.mainWindow())
+            self.dlg = self._services().EuropeOrthoDialog(self.iface.mainWindow())
             self.dlg.set_project_crs(QgsProject.instance().crs().authid())  # fallback = EPSG:4326
             self.dlg.listBtn.clicked.connect(self._on_list_layers)
             self.dlg.addBtn.clicked.connect(self._on_add_selected)
+            self.dlg.cancelBtn.clicked.connect(self._cancel_fetch)
+            self.dlg.refreshBtn.clicked.connect(self._on_refresh)
 
         self.dlg.show()
         self.dlg.raise_()
         self.dlg.activateWindow()
+        QTimer.singleShot(0, self._prefetch_capabilities)
 
     # --------- Internal helpers ---------
 
-    def _current_service_type(self, url: str) -> str:
+    def _services(self) -> SimpleNamespace:
+        if self._svc is None:
+            svc = _import_service_handlers()
+            self._list_dispatch = {
+                ServiceKind.WMS: svc.load_wms_layers,
+                ServiceKind.WMTS: svc.load_wmts_layers,
+                ServiceKind.REST: svc.load_rest_layers,
+            }
+            self._fetch_dispatch = {
+                ServiceKind.WMS: svc.fetch_wms_layers,
+                ServiceKind.WMTS: svc.fetch_wmts_layers,
+                ServiceKind.REST: svc.fetch_rest_layers,
+            }
+            self._add_dispatch = {
+                ServiceKind.WMS: self._add_wms,
+                ServiceKind.WMTS: self._add_wmts,
+                ServiceKind.REST: self._add_rest,
+            }
+            self._svc = svc
+        return self._svc
+
+    # Per-service add handlers: (name, url, payload, crs, fmt, service_info)
+
+    def _add_wms(self, name, url, payload, crs, fmt, service_info=None):
+        self._svc.add_wms_layer(name, url, crs, fmt)
+
+    def _add_wmts(self, name, url, payload, crs, fmt, service_info=None):
+        ms = None
+        wfmt = None
+        if isinstance(payload, dict):
+            ms = payload.get("default_matrix_set") or None
+            wfmt = payload.get("default_format") or None
+        else:
+            payload = None
+        self._svc.add_wmts_layer(layer_identifier=name,
+                                 wmts_link=url,
+                                 matrix_set=ms,
+                                 fmt=wfmt or fmt,
+                                 payload=payload)
+
+    def _add_rest(self, name, url, payload, crs, fmt, service_info=None):
+        self._svc.add_rest_layer(service_url=url,
+                                 layer_identifier=name,
+                                 fmt=fmt,
+                                 service_info=service_info)
+
+    def _current_service_type(self, url: str) -> ServiceKind:
         """
         Resolve the service type:
         1. Explicit selector in UI (if present)
@@ -96,48 +262,180 @@ class EuropeOrthoWMSPlugin:
         # 1) explicit UI selector
         if hasattr(self.dlg, "serviceType") and callable(getattr(self.dlg, "serviceType")):
             st = (self.dlg.serviceType() or "").strip().upper()
-            if st in {"WMS", "WMTS", "REST", "ARCGIS REST", "ARCGIS_REST"}:
-                return "REST" if "REST" in st else st
+            if st in _SELECTOR_TYPES:
+                return ServiceKind.REST if "REST" in st else ServiceKind(st)
 
         # 2) catalog type
         if get_entry and hasattr(self.dlg, "currentCatalogSelection"):
             try:
                 country, region = self.dlg.currentCatalogSelection()  # should return (country, region)
                 entry = get_entry(country, region)
-                if entry and "type" in entry:
-                    return entry["type"].upper()
+                if entry:
+                    return ServiceKind(entry.type)
             except Exception:
                 pass
 
         # 3) fallback to heuristic
         return detect_service_type(url)
 
+    def _capabilities_url(self, service_type: ServiceKind, url: str):
+        """URL the list/add handlers will request for this service (None if not fetched via net_utils)."""
+        svc = self._services()
+        if service_type is ServiceKind.WMS:
+            return svc.wms_capabilities_url(url)
+        if service_type is ServiceKind.WMTS:
+            return svc.wmts_capabilities_url(url)
+        return None  # ArcGIS REST goes through requests, not net_utils
+
+    def _recent_services(self):
+        value = QSettings().value(_SETTINGS_RECENT, []) or []
+        if isinstance(value, str):
+            value = [value]
+        recent = []
+        for token in value:
+            service_type, _, url = str(token).partition("|")
+            if url and service_type in ServiceKind.__members__:
+                recent.append((ServiceKind(service_type), url))
+        return recent
+
+    def _remember_service(self, service_type: ServiceKind, url: str):
+        token = f"{service_type}|{url}"
+        recent = [f"{t}|{u}" for t, u in self._recent_services()]
+        recent = [token] + [r for r in recent if r != token]
+        QSettings().setValue(_SETTINGS_RECENT, recent[:_RECENT_MAX])
+
+    def _prefetch_capabilities(self):
+        """
+        Warm the on-disk capabilities cache for the current catalog selection and the
+        most recently listed services on a pool worker, while the user is still
+        looking at the dialog. The selection is always fetched; recent services only
+        when they already have a disk copy (see warm_cache).
+        Best effort: every failure is ignored.
+        """
+        if self.dlg is None or self._prefetcher is not None:
+            return
+        try:
+            urls = []
+            if get_entry and hasattr(self.dlg, "currentCatalogSelection"):
+                entry = get_entry(*self.dlg.currentCatalogSelection())
+                if entry:
+                    caps_url = self._capabilities_url(ServiceKind(entry.type), entry.url)
+                    if caps_url:
+                        urls.append(caps_url)
+            selected = set(urls)
+
+            for service_type, url in self._recent_services():
+                caps_url = self._capabilities_url(service_type, url)
+                if caps_url and caps_url not in urls:
+                    urls.append(caps_url)
+            if not urls:
+                return
+            recent_only = frozenset(urls) - selected
+            warm = self._services().warm_cache
+            task = _FetchLayersTask(
+                lambda u, cancelled: warm(u, timeout_ms=_PREFETCH_TIMEOUT_MS, cached_only=recent_only), urls
+            )
+            task.signals.finished.connect(lambda _result: self._on_prefetch_done(task))
+            task.signals.failed.connect(lambda _msg: self._on_prefetch_done(task))
+            self._prefetcher = task
+            QThreadPool.globalInstance().start(task)
+        except Exception:
+            pass
+
+    def _on_prefetch_done(self, task):
+        if task is self._prefetcher:
+            self._prefetcher = None
+
     # --------- Button slots ---------
 
     def _on_list_layers(self):
+        self._list_layers()
+
+    def _list_layers(self, force_refresh: bool = False):
         url = self.dlg.urlEdit.text().strip()
         service_type = self._current_service_type(url)
-
+        self._services()
+        self._cancel_fetch()
+        self.dlg.layerModel.clear()
+
+        # Download + parse on a worker thread; only filling the model happens here.
+        fetch = self._fetch_dispatch.get(service_type)
+        if fetch is not None and not self._loader_cached(service_type, url):
+            kwargs = {}
+            if force_refresh and self._capabilities_url(service_type, url):
+                kwargs["force_refresh"] = True  # skip the net_utils disk cache too
+            self._start_list_task(service_type, url, fetch, **kwargs)
+        else:
+            self._run_loader(service_type, url)
+
+    def _on_refresh(self):
+        for clear in self._services().clear_caches:
+            clear()
+        self._list_layers(force_refresh=True)
+
+    def _loader_cached(self, service_type: ServiceKind, url: str) -> bool:
+        """True if the loader can answer from its in-memory cache (no download needed)."""
+        if service_type is ServiceKind.WMS:
+            return self._services().wms_is_cached(url)
+        if service_type is ServiceKind.WMTS:
+            return self._services().wmts_is_cached(url)
+        return False
+
+    def _run_loader(self, service_type: ServiceKind, url: str, **kwargs):
         try:
-            self.dlg.tree.clear()
-
-            if service_type == "WMS":
-                load_wms_layers(url, self.dlg.tree)
-            elif service_type == "WMTS":
-                load_wmts_layers(url, self.dlg.tree)
-            elif service_type == "REST":
-                load_rest_layers(url, self.dlg.tree)
-            else:
+            loader = self._list_dispatch.get(service_type)
+            if loader is None:
                 raise ValueError(f"Unknown service type: {service_type}")
+            loader(url, self.dlg.layerModel, **kwargs)
+
+            if self.dlg.layerModel.rowCount():
+                self._remember_service(service_type, url)
 
         except NotImplementedError as e:
             QMessageBox.information(self.iface.mainWindow(), "Not available", str(e))
         except Exception as e:
             QMessageBox.critical(self.iface.mainWindow(), f"{service_type} Error", str(e))
 
+    # --------- Background listing ---------
+
+    def _start_list_task(self, service_type: ServiceKind, url: str, fetch, **fetch_kwargs):
+        task = _FetchLayersTask(fetch, url, **fetch_kwargs)
+        task.signals.finished.connect(
+            lambda parsed: self._on_list_done(task, service_type, url, parsed)
+        )
+        task.signals.failed.connect(
+            lambda msg: self._on_list_failed(task, service_type, msg)
+        )
+        self._fetcher = task
+        self.dlg.set_busy(True)
+        QThreadPool.globalInstance().start(task)
+
+    def _on_list_done(self, task, service_type: ServiceKind, url: str, parsed):
+        if task is not self._fetcher:
+            return  # superseded or cancelled
+        self._fetcher = None
+        self.dlg.set_busy(False)
+        self._run_loader(service_type, url, parsed=parsed)
+
+    def _on_list_failed(self, task, service_type: ServiceKind, msg: str):
+        if task is not self._fetcher:
+            return
+        self._fetcher = None
+        self.dlg.set_busy(False)
+        QMessageBox.critical(self.iface.mainWindow(), f"{service_type} Error", msg)
+
+    def _cancel_fetch(self):
+        fetcher, self._fetcher = self._fetcher, None
+        if fetcher is not None:
+            fetcher.cancel()
+        if self.dlg is not None:
+            self.dlg.set_busy(False)
+
     def _on_add_selected(self):
         url = self.dlg.urlEdit.text().strip()
         service_type = self._current_service_type(url)
+        self._services()
+        handler = self._add_dispatch.get(service_type)
 
         # Common UI fields 
         crs = self.dlg.crsLabel.text().strip() or "EPSG:4326"
@@ -148,12 +446,11 @@ class EuropeOrthoWMSPlugin:
         selected_items = get_items() if callable(get_items) else None
 
         if selected_items:
-            entries = []
-            for it in selected_items:
-                name = it.text(0)  # layer identifier / name
-                base_url = it.data(0, Qt.UserRole) or url
-                payload = it.data(0, Qt.UserRole + 1)
-                entries.append((name, base_url, payload))
+            # Rows are (name, detail, url, payload, service_info) tuples straight from the model
+            entries = [
+                (name, row_url or url, payload, service_info)
+                for name, _detail, row_url, payload, service_info in selected_items
+            ]
         else:
             # Fallback to names only (uses the URL from the text field)
             names = self.dlg.selected_layer_names()
@@ -165,35 +462,25 @@ class EuropeOrthoWMSPlugin:
                 )
                 return
             # payload is unknown in this path; use None
-            entries = [(n, url, None) for n in names]
+            entries = [(n, url, None, None) for n in names]
 
+        # Add all layers with rendering suspended so the canvas redraws once, not per layer.
         errors = []
-        for name, effective_url, payload in entries:
-            try:
-                if service_type == "WMS":
-                    add_wms_layer(name, effective_url, crs, fmt)
-
-                elif service_type == "WMTS":
-                    ms = None
-                    wfmt = None
-                    if isinstance(payload, dict):
-                        ms = payload.get("default_matrix_set") or None
-                        wfmt = payload.get("default_format") or None
-                    add_wmts_layer(layer_identifier=name,
-                                   wmts_link=effective_url,
-                                   matrix_set=ms,
-                                   fmt=wfmt or fmt)
-
-                elif service_type == "REST":
-                    add_rest_layer(service_url=effective_url,
-                                   layer_identifier=name,
-                                   fmt=fmt)
-
-                else:
-                    raise ValueError(f"Unknown service type: {service_type}")
-
-            except Exception as e:
-                errors.append(f"{name}: {e}")
+        canvas = self.iface.mapCanvas()
+        was_rendering = canvas.renderFlag()  # the user may have switched rendering off
+        canvas.setRenderFlag(False)
+        try:
+            for name, effective_url, payload, service_info in entries:
+                try:
+                    if handler is None:
+                        raise ValueError(f"Unknown service type: {service_type}")
+                    handler(name, effective_url, payload, crs, fmt, service_info)
+                except Exception as e:
+                    errors.append(f"{name}: {e}")
+        finally:
+            canvas.setRenderFlag(was_rendering)
+            if was_rendering:
+                canvas.refresh()
 
         if errors:
             QMessageBox.warning(
@@ -1,79 +1,443 @@
-from typing import Tuple, Optional
-from PyQt5.QtCore import QEventLoop, QTimer, QUrl
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zlib
+from typing import Callable, Collection, Dict, List, Tuple, Optional
+from PyQt5.QtCore import QEventLoop, QTimer, QUrl, QStandardPaths
 from PyQt5.QtNetwork import QNetworkRequest, QNetworkReply
-from qgis.PyQt.QtNetwork import QNetworkRequest as QgsQNetworkRequest  # safety across builds
 from qgis.core import QgsNetworkAccessManager
 
 _DEFAULT_TIMEOUT_MS = 15000
 _MAX_REDIRECTS = 5
 _UA = b"QGIS-Plugin-EuropeOrtho/1.0"
+_CACHE_SUBDIR = "EuropeOrthoViewer"
+_STREAM_CHUNK = 64 * 1024
+_GZIP_MAGIC = b"\x1f\x8b"
+_CACHE_MAX_BYTES = 256 * 1024 * 1024  # oldest bodies are evicted beyond this
+_CACHE_MAX_AGE_S = 30 * 24 * 3600  # files untouched this long are dropped
 
-def _make_request(url: str) -> QNetworkRequest:
+
+# ------------------------------ Disk cache ------------------------------ #
+
+def _cache_dir() -> str:
+    """Directory for cached response bodies (created on first use)."""
+    base = QStandardPaths.writableLocation(QStandardPaths.CacheLocation) or tempfile.gettempdir()
+    path = os.path.join(base, _CACHE_SUBDIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _cache_paths(url: str) -> Tuple[str, str]:
+    """(body_path, meta_path) for a URL; files are named after sha1(url)."""
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    body = os.path.join(_cache_dir(), key)
+    return body, body + ".meta"
+
+
+def _cache_load(url: str) -> Optional[Dict]:
+    """Return the sidecar metadata for a cached URL, or None if absent/corrupt."""
+    try:
+        body_path, meta_path = _cache_paths(url)
+        if not os.path.exists(body_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as fh:
+            meta = json.load(fh)
+        return meta if isinstance(meta, dict) else None
+    except (OSError, ValueError):
+        return None
+
+
+def _cache_read_body(url: str) -> Optional[bytes]:
+    try:
+        body_path, _ = _cache_paths(url)
+        with open(body_path, "rb") as fh:
+            return fh.read()
+    except OSError:
+        return None
+
+
+def _cache_touch(url: str) -> None:
+    """Mark a body as just used (a 304 hit), so _cache_prune evicts it last."""
+    try:
+        os.utime(_cache_paths(url)[0])
+    except OSError:
+        pass
+
+
+def _cache_store(url: str, data: bytes, final_url: str, etag: str, last_modified: str) -> None:
+    """Persist body + validators. Only worth it when the server gave us a validator."""
+    if not (etag or last_modified):
+        return
+    fh = _cache_open_temp()
+    if fh is None:
+        return
+    try:
+        fh.write(data)
+    except OSError:
+        _cache_discard(fh)
+        return
+    _cache_commit(url, fh, final_url, etag, last_modified)
+
+
+def _cache_open_temp():
+    """Temp file in the cache dir for a body being streamed, or None if it can't be created."""
+    try:
+        return tempfile.NamedTemporaryFile(dir=_cache_dir(), suffix=".part", delete=False)
+    except OSError:
+        return None
+
+
+def _cache_commit(url: str, fh, final_url: str, etag: str, last_modified: str) -> None:
+    """
+    Move a fully written temp body into place and write its sidecar the same way,
+    so readers never see a half-written file.
+    """
+    try:
+        fh.close()
+        body_path, meta_path = _cache_paths(url)
+        os.replace(fh.name, body_path)
+        meta = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "final_url": final_url,
+            "fetched_at": time.time(),
+        }
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(meta_path),
+                                         suffix=".part", delete=False) as fh_meta:
+            json.dump(meta, fh_meta)
+        os.replace(fh_meta.name, meta_path)
+    except OSError:
+        _cache_discard(fh)
+        return
+    _cache_prune()
+
+
+def _cache_prune() -> None:
+    """Drop files older than _CACHE_MAX_AGE_S, then the oldest until under _CACHE_MAX_BYTES."""
+    try:
+        cache_dir = _cache_dir()
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+    except OSError:
+        return
+
+    cutoff = time.time() - _CACHE_MAX_AGE_S
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in sorted(entries):
+        if mtime >= cutoff and total <= _CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)  # a body without its sidecar (or vice versa) is a cache miss
+        except OSError:
+            continue
+        total -= size
+
+
+def _cache_discard(fh) -> None:
+    try:
+        fh.close()
+        os.remove(fh.name)
+    except OSError:
+        pass
+
+
+def _cache_replay(url: str, on_chunk: Callable[[bytes], None]) -> bool:
+    """Feed a cached body to 'on_chunk' in _STREAM_CHUNK pieces; False if it is missing."""
+    try:
+        body_path, _ = _cache_paths(url)
+        with open(body_path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(_STREAM_CHUNK), b""):
+                on_chunk(chunk)
+    except OSError:
+        return False
+    return True
+
+
+# ------------------------------ gzip bodies ------------------------------ #
+# Qt inflates Content-Encoding: gzip/deflate itself. What still reaches us gzipped is a
+# gzip *file* (e.g. capabilities.xml.gz, or a proxy that double-compresses), so bodies
+# are sniffed for the gzip magic instead of trusting headers.
+
+def _gunzip_if_needed(data: bytes) -> bytes:
+    """Inflate a body that starts with the gzip magic (C zlib); anything else is returned as-is."""
+    if not data.startswith(_GZIP_MAGIC):
+        return data
+    try:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    except zlib.error:
+        return data  # not actually gzip; let the caller's parser report it
+
+
+class _GunzipFeed:
+    """
+    'on_chunk' wrapper for http_stream: passes the body through untouched unless it
+    starts with the gzip magic, in which case it is inflated incrementally (C zlib),
+    so the parser still sees plain XML chunk by chunk. Call close() after the last chunk.
+    """
+
+    def __init__(self, on_chunk: Callable[[bytes], None]):
+        self._on_chunk = on_chunk
+        self._head = b""  # first bytes, until the magic can be checked
+        self._sniffed = False
+        self._inflater = None
+
+    def __call__(self, chunk: bytes) -> None:
+        if not self._sniffed:
+            self._head += chunk
+            if len(self._head) < len(_GZIP_MAGIC):
+                return
+            self._sniffed = True
+            if self._head.startswith(_GZIP_MAGIC):
+                self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            chunk, self._head = self._head, b""
+        if self._inflater is None:
+            self._on_chunk(chunk)
+            return
+        try:
+            out = self._inflater.decompress(chunk)
+        except zlib.error as e:
+            raise RuntimeError(f"Corrupt gzip body: {e}") from e
+        if out:
+            self._on_chunk(out)
+
+    def close(self) -> None:
+        if not self._sniffed:
+            if self._head:  # body shorter than the magic
+                self._on_chunk(self._head)
+            return
+        if self._inflater is not None:
+            out = self._inflater.flush()
+            if out:
+                self._on_chunk(out)
+
+
+# ------------------------------ HTTP ------------------------------ #
+
+def _make_request(url: str, timeout_ms: int = _DEFAULT_TIMEOUT_MS, cache_meta: Optional[Dict] = None) -> QNetworkRequest:
     req = QNetworkRequest(QUrl(url))
+    req.setTransferTimeout(timeout_ms)  # enforced by the NAM, aborts with OperationCanceledError
     req.setRawHeader(b"User-Agent", _UA)
-    req.setAttribute(QNetworkRequest.FollowRedirectsAttribute, True)
+    # Qt follows redirects itself (never https -> http), up to _MAX_REDIRECTS hops
+    req.setAttribute(QNetworkRequest.RedirectPolicyAttribute, QNetworkRequest.NoLessSafeRedirectPolicy)
+    req.setMaximumRedirectsAllowed(_MAX_REDIRECTS)
+    # Qt already advertises "Accept-Encoding: gzip, deflate" and inflates the body
+    # transparently; setting the header by hand would switch that off.
+    req.setAttribute(QNetworkRequest.HTTP2AllowedAttribute, True)
+    if cache_meta:
+        if cache_meta.get("etag"):
+            req.setRawHeader(b"If-None-Match", cache_meta["etag"].encode("latin-1"))
+        if cache_meta.get("last_modified"):
+            req.setRawHeader(b"If-Modified-Since", cache_meta["last_modified"].encode("latin-1"))
     return req
 
-def _blocking_get(url: str, timeout_ms: int) -> Tuple[Optional[bytes], Optional[str]]:
-    """Returns (bytes, final_url) or (None, error_text)."""
-    nam = QgsNetworkAccessManager.instance()
-    req = _make_request(url)
-    reply = nam.get(req)
+def _finish_reply(
+    url: str, reply: QNetworkReply, cache_meta: Optional[Dict], want_body: bool = True,
+) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    Turn a finished reply into (bytes, final_url) or (None, error_text).
+    Serves the cached body on 304 and stores fresh bodies that carry validators.
+    With want_body=False the cached body is not read back on a 304 and a fresh one
+    is stored as received; the bytes returned are then b"".
+    Schedules the reply for deletion.
+    """
+    if reply.error() != QNetworkReply.NoError:
+        msg = reply.errorString()
+        reply.deleteLater()
+        return None, msg
+
+    # 304 Not Modified -> serve the cached body
+    status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+    if status == 304 and cache_meta:
+        reply.deleteLater()
+        _cache_touch(url)
+        if not want_body:
+            return b"", cache_meta.get("final_url") or url
+        cached = _cache_read_body(url)
+        if cached is None:
+            return None, "Server answered 304 but the cached copy is missing"
+        # http_stream caches bodies as received, so this may still be a gzip file
+        return _gunzip_if_needed(cached), cache_meta.get("final_url") or url
+
+    data = bytes(reply.readAll())  # one copy out of the QByteArray
+    if want_body:
+        data = _gunzip_if_needed(data)
+    final_url = reply.url().toString()
+    etag = bytes(reply.rawHeader(b"ETag")).decode("latin-1")
+    last_modified = bytes(reply.rawHeader(b"Last-Modified")).decode("latin-1")
+    reply.deleteLater()
+    _cache_store(url, data, final_url, etag, last_modified)
+    return (data if want_body else b""), final_url
+
+def http_get_many(
+    urls: List[str], timeout_ms: int = _DEFAULT_TIMEOUT_MS, want_body: bool = True,
+) -> List[Tuple[Optional[bytes], str]]:
+    """
+    Concurrent GET of several URLs through the shared QGIS NAM.
+    All requests are issued up front and awaited on a single event loop, so
+    wall time is bounded by the slowest reply rather than the sum, and the NAM
+    can multiplex same-host requests over one keep-alive / HTTP/2 connection.
+    Returns one (bytes, final_url) or (None, error_text) per URL, in order;
+    never raises for individual failures. want_body=False is for cache warm-up,
+    see _finish_reply.
+    """
+    results: List[Optional[Tuple[Optional[bytes], str]]] = [None] * len(urls)
+    if not urls:
+        return []
 
+    nam = QgsNetworkAccessManager.instance()
     loop = QEventLoop()
     timer = QTimer()
     timer.setSingleShot(True)
-    timer.timeout.connect(loop.quit)
-    reply.finished.connect(loop.quit)
+    timer.timeout.connect(loop.quit)  # hard cap for the whole batch
+
+    replies: Dict[int, QNetworkReply] = {}
+    metas = [_cache_load(u) for u in urls]
+    pending = [len(urls)]
+
+    def on_finished(i: int, reply: QNetworkReply):
+        results[i] = _finish_reply(urls[i], reply, metas[i], want_body)
+        replies.pop(i, None)
+        pending[0] -= 1
+        if pending[0] == 0:
+            loop.quit()
+
+    for i, u in enumerate(urls):
+        reply = nam.get(_make_request(u, timeout_ms, metas[i]))
+        replies[i] = reply
+        reply.finished.connect(lambda i=i, reply=reply: on_finished(i, reply))
+
     timer.start(timeout_ms)
-    loop.exec_()
+    if pending[0]:
+        loop.exec_()
+    timer.stop()
 
-    if timer.isActive():  # finished not timed out
-        timer.stop()
-    else:  # timeout
+    # Whatever is still in flight timed out
+    for i, reply in list(replies.items()):
+        try:
+            reply.finished.disconnect()
+        except TypeError:
+            pass
         reply.abort()
         reply.deleteLater()
-        return None, f"Timeout after {timeout_ms} ms"
-
-    err = reply.error()
-    redirects = 0
-    while err == QNetworkReply.NoError:
-        redir = reply.attribute(QNetworkRequest.RedirectionTargetAttribute)
-        if redir and redirects < _MAX_REDIRECTS:
-            target = reply.url().resolved(redir)
-            reply.deleteLater()
-            req2 = _make_request(target.toString())
-            reply = nam.get(req2)
-
-            timer.start(timeout_ms)
-            loop.exec_()
-            if timer.isActive():
-                timer.stop()
-            else:
-                reply.abort()
-                reply.deleteLater()
-                return None, f"Timeout after {timeout_ms} ms (redirect)"
-            err = reply.error()
-            redirects += 1
-            continue
-        break
+        results[i] = (None, f"Timeout after {timeout_ms} ms")
 
-    if err != QNetworkReply.NoError:
-        msg = reply.errorString()
-        reply.deleteLater()
-        return None, msg
+    return [r if r is not None else (None, "No reply") for r in results]
+
+
+def warm_cache(
+    urls: List[str], timeout_ms: int = _DEFAULT_TIMEOUT_MS, cached_only: Collection[str] = (),
+) -> None:
+    """
+    Fetch 'urls' into the on-disk cache with one concurrent GET each (conditional
+    when a copy exists, and a 304 leaves that copy unread). A fresh body is kept
+    when the server sends ETag/Last-Modified.
+    URLs in 'cached_only' are skipped unless they already have a copy: a service
+    listed before without one served no validators, so fetching it early is wasted.
+    Blocking, never raises for individual failures; meant for a worker thread.
+    """
+    urls = [u for u in urls if u not in cached_only or _cache_load(u) is not None]
+    if urls:
+        http_get_many(urls, timeout_ms=timeout_ms, want_body=False)
 
-    data = reply.readAll().data()
-    final_url = reply.url().toString()
-    reply.deleteLater()
-    return data, final_url
 
-def http_get_bytes(url: str, timeout_ms: int = _DEFAULT_TIMEOUT_MS) -> Tuple[bytes, str]:
+def http_stream(
+    url: str,
+    on_chunk: Callable[[bytes], None],
+    timeout_ms: int = _DEFAULT_TIMEOUT_MS,
+    force_refresh: bool = False,
+) -> str:
     """
-    Blocking GET via QGIS NAM. Respects QGIS SSL exceptions & proxy.
-    Raises RuntimeError on failure.
+    Blocking GET that hands the body to 'on_chunk' piece by piece as it arrives
+    (QNetworkReply.readyRead), so e.g. an ET.XMLPullParser can parse while the
+    download is still running and no full-body bytes object is ever built:
+
+        parser = ET.XMLPullParser(["start", "end"])
+        http_stream(url, parser.feed)
+
+    Shares the on-disk cache with http_get_many: the request is conditional, a 304
+    replays the cached body in _STREAM_CHUNK pieces, and a fresh body carrying
+    validators is written to the cache file as it streams (never held in memory).
+    Pass force_refresh=True to send an unconditional request (the fresh body still
+    replaces the cached one).
+    A gzip-file body is inflated on the fly before it reaches 'on_chunk'.
+    Returns the final URL; raises RuntimeError on failure.
     """
-    data, err_or_url = _blocking_get(url, timeout_ms)
-    if data is None:
-        raise RuntimeError(f"Network error for {url}: {err_or_url}")
-    return data, err_or_url  
+    on_chunk = _GunzipFeed(on_chunk)
+    nam = QgsNetworkAccessManager.instance()
+    cache_meta = None if force_refresh else _cache_load(url)
+    reply = nam.get(_make_request(url, timeout_ms, cache_meta))
+    loop = QEventLoop()
+    errors: List[Exception] = []
+    tee = []  # [open temp file] once we know the reply is cacheable
+
+    def body_ok() -> bool:
+        # error pages and 304s must not reach the parser or the cache file
+        if reply.error() != QNetworkReply.NoError:
+            return False
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        return status is None or 200 <= int(status) < 300
+
+    def pump():
+        chunk = bytes(reply.readAll())
+        if not chunk or errors or not body_ok():
+            return
+        if not tee and (reply.rawHeader(b"ETag") or reply.rawHeader(b"Last-Modified")):
+            tee.append(_cache_open_temp())
+        if tee and tee[0] is not None:
+            try:
+                tee[0].write(chunk)
+            except OSError:  # the cache is best effort; keep streaming without it
+                _cache_discard(tee[0])
+                tee[0] = None
+        try:
+            on_chunk(chunk)
+        except Exception as e:  # stop feeding, report after the loop
+            errors.append(e)
+            reply.abort()
+
+    reply.readyRead.connect(pump)
+    reply.finished.connect(loop.quit)
+    if not reply.isFinished():
+        loop.exec_()
+
+    try:
+        if errors:
+            raise errors[0]
+        if reply.error() != QNetworkReply.NoError:
+            msg = reply.errorString()
+            if reply.error() == QNetworkReply.OperationCanceledError:
+                msg = f"Timeout after {timeout_ms} ms"
+            raise RuntimeError(f"Network error for {url}: {msg}")
+
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if status == 304 and cache_meta:
+            if not _cache_replay(url, on_chunk):
+                raise RuntimeError(f"Network error for {url}: Server answered 304 but the cached copy is missing")
+            _cache_touch(url)
+            on_chunk.close()
+            return cache_meta.get("final_url") or url
+        if not body_ok():
+            raise RuntimeError(f"Network error for {url}: HTTP {status}")
+
+        pump()  # whatever arrived together with 'finished'
+        if errors:
+            raise errors[0]
+        on_chunk.close()
+        final_url = reply.url().toString()
+        if tee and tee[0] is not None:
+            fh, tee[0] = tee[0], None
+            _cache_commit(
+                url, fh, final_url,
+                bytes(reply.rawHeader(b"ETag")).decode("latin-1"),
+                bytes(reply.rawHeader(b"Last-Modified")).decode("latin-1"),
+            )
+        return final_url
+    finally:
+        if tee and tee[0] is not None:  # failed part-way: drop the partial body
+            _cache_discard(tee[0])
+        reply.deleteLater()
@@ -1,94 +1,157 @@
 
 import json
-from typing import Dict, List, Optional, Tuple
-from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import re
+import time
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Callable, Dict, FrozenSet, List, Mapping, Optional, Tuple
+from urllib.parse import quote, urlsplit, urlunsplit, parse_qsl, urlencode
 
 import requests
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QTreeWidgetItem, QMessageBox
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PyQt5.QtWidgets import QMessageBox
 from qgis.core import QgsProject, QgsRasterLayer, QgsVectorLayer
 
 
+try:  # C parser, straight from the UTF-8 bytes; decode errors are still ValueErrors
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+_JSON_TTL_S = 120
+# Characters left alone when escaping URI values: keeps service URLs readable and
+# already-escaped paths intact, while '&', '=' and spaces can't split the URI.
+_URI_SAFE = ":/%"
+_F_JSON_RE = re.compile(r"[?&]f=json\b", re.IGNORECASE)
+_SVC_RE = re.compile(r"/(featureserver|mapserver|imageserver)", re.IGNORECASE)
+_SVC_MAP = {"featureserver": "FEATURE", "mapserver": "MAP", "imageserver": "MAP"}
+_FORMAT_PREFS = ("png32", "png24", "png8", "png", "jpg", "jpeg")
+_UA = "QGIS-Plugin-REST/1.0"
+_READ_CHUNK = 64 * 1024
+
+# json_url -> (expires_at, parsed service JSON, its _layer_index); shared by
+# load_rest_layers and add_rest_layer, the index expires together with the JSON
+_REST_CACHE: Dict[str, Tuple[float, Dict, Tuple[Dict, Dict, List]]] = {}
+
+
+def _make_session() -> requests.Session:
+    """One keep-alive connection pool for all REST calls (listing and adding reuse the TLS session)."""
+    s = requests.Session()
+    s.headers.update({"User-Agent": _UA, "Accept-Encoding": "gzip, deflate"})
+    retry = Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET"}))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+_SESSION = _make_session()
+
+
 # ------------------------------ Public API ------------------------------ #
 
-def load_rest_layers(service_url: str, tree_widget) -> None:
-    """
-    Fetch ArcGIS REST (MapServer / FeatureServer / ImageServer) JSON and populate the tree.
+def clear_caches() -> None:
+    """Drop all cached service JSON (bound to the dialog's Refresh button)."""
+    _REST_CACHE.clear()
 
-    Each item added to 'tree_widget' has:
-      - Column 0: layer name (string)
-      - Column 1: "ID <id>"
-      - Data(0, Qt.UserRole): cleaned base service URL (no query)
-      - Data(0, Qt.UserRole + 1): payload dict with keys:
-          {
-            "service_type": "MAP" | "FEATURE",
-            "id": <int>,
-            "name": <str>,
-            "geometryType": <str or None>,       # FeatureServer layers
-            "formats": [<str>, ...]              # MapServer/ImageServer supported formats (normalized)
-          }
+
+def fetch_rest_layers(
+    service_url: str, cancelled: Optional[Callable[[], bool]] = None,
+) -> Tuple[str, str, Mapping]:
+    """
+    Fetch the ArcGIS REST service JSON without touching any widget, so it can run
+    on a worker thread. 'cancelled' (optional callable) is polled while the body
+    is read and stops the download once it returns True.
+    Returns (base_url, "MAP" | "FEATURE", read-only service JSON);
+    raises RuntimeError with the details.
     """
     base_url = _clean_base_url(service_url)
     try:
-        info = _fetch_json(_ensure_json_suffix(base_url))
+        info = _fetch_json(_ensure_json_suffix(base_url), cancelled=cancelled)
         svc_type = _detect_service_type_from_url(base_url)
 
         if svc_type == "UNKNOWN":
             svc_type = _detect_service_type_from_payload(info)
 
         if svc_type == "MAP":
-            layers = info.get("layers") or []
-            formats = _parse_supported_formats(info.get("supportedImageFormatTypes", ""))
-            if not layers:
+            if not info.get("layers"):
                 raise ValueError("No layers advertised by MapServer/ImageServer.")
-
-            for L in layers:
-                lid = L.get("id")
-                lname = L.get("name", f"Layer {lid}")
-                item = QTreeWidgetItem([lname, f"ID {lid}"])
-                item.setCheckState(0, Qt.Unchecked)
-                item.setData(0, Qt.UserRole, base_url)
-                payload = {
-                    "service_type": "MAP",
-                    "id": lid,
-                    "name": lname,
-                    "geometryType": None,
-                    "formats": formats,
-                }
-                item.setData(0, Qt.UserRole + 1, payload)
-                tree_widget.addTopLevelItem(item)
-
         elif svc_type == "FEATURE":
-            layers = info.get("layers") or []
-            if not layers:
+            if not info.get("layers"):
                 raise ValueError("No layers advertised by FeatureServer.")
-
-            for L in layers:
-                lid = L.get("id")
-                lname = L.get("name", f"Layer {lid}")
-                gtype = L.get("geometryType")
-                item = QTreeWidgetItem([lname, f"ID {lid}"])
-                item.setCheckState(0, Qt.Unchecked)
-                item.setData(0, Qt.UserRole, base_url)
-                payload = {
-                    "service_type": "FEATURE",
-                    "id": lid,
-                    "name": lname,
-                    "geometryType": gtype,
-                    "formats": [],
-                }
-                item.setData(0, Qt.UserRole + 1, payload)
-                tree_widget.addTopLevelItem(item)
-
         else:
             raise ValueError("Unsupported or unknown ArcGIS service URL. Use a MapServer or FeatureServer endpoint.")
 
+        # Read-only view shared by every row (and by the JSON cache entry behind it);
+        # LayerListModel keeps rows as plain tuples, so all rows hold this one object.
+        return base_url, svc_type, MappingProxyType(info)
+
     except (requests.RequestException, ValueError) as e:
-        QMessageBox.critical(
-            None,
-            "ArcGIS REST Error",
-            f"Failed to read ArcGIS REST service:\n{base_url}\n\n{e}"
-        )
+        raise RuntimeError(f"Failed to read ArcGIS REST service:\n{base_url}\n\n{e}") from e
+
+
+def load_rest_layers(
+    service_url: str,
+    model,
+    parsed: Optional[Tuple[str, str, Mapping]] = None,
+) -> None:
+    """
+    Fill the dialog's layer list model with the layers of an ArcGIS REST (MapServer /
+    FeatureServer / ImageServer) service. 'parsed' is an optional
+    fetch_rest_layers(service_url) result, e.g. computed off the UI thread; without
+    it the JSON is fetched here.
+
+    Each row is (name, "ID <id>", url, payload, service_info):
+      - url: cleaned base service URL (no query)
+      - service_info: read-only view of the service JSON (shared by all rows;
+        pass it back as add_rest_layer(service_info=...) to skip the refetch)
+      - payload: dict with keys:
+          {
+            "service_type": "MAP" | "FEATURE",
+            "id": <int>,
+            "name": <str>,
+            "geometryType": <str or None>,       # FeatureServer layers
+            "formats": (<str>, ...)              # MapServer/ImageServer supported formats (normalized)
+          }
+    """
+    if parsed is None:
+        try:
+            parsed = fetch_rest_layers(service_url)
+        except RuntimeError as e:
+            QMessageBox.critical(None, "ArcGIS REST Error", str(e))
+            return
+    base_url, svc_type, shared_info = parsed
+
+    rows = []
+    if svc_type == "MAP":
+        formats, _ = _parse_supported_formats(shared_info.get("supportedImageFormatTypes", ""))
+        for L in shared_info.get("layers") or []:
+            lid = L.get("id")
+            lname = L.get("name", f"Layer {lid}")
+            payload = {
+                "service_type": "MAP",
+                "id": lid,
+                "name": lname,
+                "geometryType": None,
+                "formats": formats,
+            }
+            rows.append((lname, f"ID {lid}", base_url, payload, shared_info))
+
+    else:  # FEATURE
+        for L in shared_info.get("layers") or []:
+            lid = L.get("id")
+            lname = L.get("name", f"Layer {lid}")
+            payload = {
+                "service_type": "FEATURE",
+                "id": lid,
+                "name": lname,
+                "geometryType": L.get("geometryType"),
+                "formats": (),
+            }
+            rows.append((lname, f"ID {lid}", base_url, payload, shared_info))
+
+    model.set_rows(rows)
 
 
 def add_rest_layer(
@@ -97,6 +160,7 @@ def add_rest_layer(
     fmt: Optional[str] = None,
     where: Optional[str] = None,
     time_params: Optional[Tuple[int, int]] = None,
+    service_info: Optional[Mapping] = None,
 ) -> None:
     """
     Add a MapServer/ImageServer (raster) or FeatureServer (vector) layer to the QGIS project.
@@ -106,19 +170,21 @@ def add_rest_layer(
     - 'layer_identifier' can be a numeric id (as string/int) or layer name (case-insensitive)
     - 'fmt' (MapServer/ImageServer): preferred image format token (e.g., 'png32', 'png', 'jpg').
     - 'where' (FeatureServer): optional attribute filter via setSubsetString (client-side)
+    - 'service_info': service JSON already fetched by load_rest_layers (item data UserRole + 2);
+      when given, no request is made
     """
     base_url = _clean_base_url(service_url)
     try:
-        info = _fetch_json(_ensure_json_suffix(base_url))
+        info = service_info if service_info is not None else _fetch_json(_ensure_json_suffix(base_url))
         svc_type = _detect_service_type_from_url(base_url)
         if svc_type == "UNKNOWN":
             svc_type = _detect_service_type_from_payload(info)
 
         # Resolve target layer (id + name)
-        target_id, target_name = _resolve_layer(info, layer_identifier)
+        target_id, target_name = _resolve_layer(info, layer_identifier, _ensure_json_suffix(base_url))
 
         if svc_type == "FEATURE":
-            lyr_url = f"{_strip_trailing_slash(base_url)}/{target_id}"
+            lyr_url = quote(f"{_strip_trailing_slash(base_url)}/{target_id}", safe=_URI_SAFE)
             display_name = target_name or f"Feature {target_id}"
 
             candidates = [
@@ -149,20 +215,22 @@ def add_rest_layer(
             svc_root = _strip_trailing_slash(base_url)  # .../MapServer
 
             # Available formats from service; choose a concrete one (lowercase tokens)
-            formats = _parse_supported_formats(info.get("supportedImageFormatTypes", ""))
-            chosen_fmt = _prefer_arcgis_format(fmt, formats)  
+            formats, format_set = _parse_supported_formats(info.get("supportedImageFormatTypes", ""))
+            chosen_fmt = _prefer_arcgis_format(fmt, formats, format_set)  
 
             display_name = target_name or f"Map {target_id}"
             rlayer = None
 
-            candidate_param_lists = [
-                [f"layers=show:{target_id}", f"format={chosen_fmt}", f"url={svc_root}"],
-                [f"layers=show:{target_id}",                         f"url={svc_root}"],
-                [                                                     f"url={svc_root}"],
+            # Shared pieces, escaped once; the candidates only differ in what they include
+            url_param = f"url={quote(svc_root, safe=_URI_SAFE)}"
+            show_param = f"layers=show:{target_id}"
+            candidate_uris = [
+                f"{show_param}&format={quote(chosen_fmt, safe=_URI_SAFE)}&{url_param}",
+                f"{show_param}&{url_param}",
+                url_param,
             ]
 
-            for plist in candidate_param_lists:
-                uri = "&".join(plist)
+            for uri in candidate_uris:
                 rlayer = QgsRasterLayer(uri, display_name, "arcgismapserver")
                 if rlayer.isValid():
                     try:
@@ -195,16 +263,43 @@ def add_rest_layer(
 
 # ------------------------------ Helpers ------------------------------ #
 
-def _fetch_json(url: str, timeout: int = 15) -> Dict:
-    """GET JSON from ArcGIS REST; ensures '?f=json' is present."""
-    resp = requests.get(_ensure_json_suffix(url), timeout=timeout, headers={"User-Agent": "QGIS-Plugin-REST/1.0"})
+def _fetch_json(
+    json_url: str,
+    timeout: int = 15,
+    ttl: float = _JSON_TTL_S,
+    cancelled: Optional[Callable[[], bool]] = None,
+) -> Dict:
+    """
+    GET JSON from ArcGIS REST. 'json_url' must already carry 'f=json' (see _ensure_json_suffix).
+    Cached in memory for 'ttl' seconds, together with the layer lookup tables.
+    With 'cancelled', the body is read in _READ_CHUNK pieces and the connection is
+    dropped (RuntimeError("Cancelled")) as soon as it returns True.
+    """
+    hit = _REST_CACHE.get(json_url)
+    if hit is not None and time.monotonic() < hit[0]:
+        return hit[1]
+
+    resp = _SESSION.get(json_url, timeout=timeout, stream=cancelled is not None)
     resp.raise_for_status()
-    return resp.json()
+    if cancelled is None:
+        body = resp.content
+    else:
+        parts = []
+        for part in resp.iter_content(_READ_CHUNK):
+            if cancelled():
+                resp.close()
+                raise RuntimeError("Cancelled")
+            parts.append(part)
+        body = b"".join(parts)
+    data = _json_loads(body)  # skips resp.json()'s charset sniffing
+    if "error" not in data:  # ArcGIS reports failures as HTTP 200 + {"error": ...}
+        _REST_CACHE[json_url] = (time.monotonic() + ttl, data, _layer_index(data))
+    return data
 
 
 def _ensure_json_suffix(url: str) -> str:
     """Ensure '?f=json' (or '&f=json') is present."""
-    if "f=json" in url.lower():
+    if _F_JSON_RE.search(url):
         return url
     sep = "&" if ("?" in url) else "?"
     return f"{url}{sep}f=json"
@@ -222,14 +317,8 @@ def _strip_trailing_slash(u: str) -> str:
 
 
 def _detect_service_type_from_url(url: str) -> str:
-    u = url.lower()
-    if "/featureserver" in u:
-        return "FEATURE"
-    if "/mapserver" in u:
-        return "MAP"
-    if "/imageserver" in u:
-        return "MAP"
-    return "UNKNOWN"
+    m = _SVC_RE.search(url)
+    return _SVC_MAP[m.group(1).lower()] if m else "UNKNOWN"
 
 
 def _detect_service_type_from_payload(info: Dict) -> str:
@@ -241,53 +330,90 @@ def _detect_service_type_from_payload(info: Dict) -> str:
     return "UNKNOWN"
 
 
-def _resolve_layer(service_info: Dict, layer_identifier: str) -> Tuple[int, Optional[str]]:
+def _layer_index(service_info: Mapping) -> Tuple[Dict, Dict, List]:
+    """
+    Lookup tables for the service's 'layers' (stored in the _REST_CACHE entry):
+      - id_map: {id: (id, name)}
+      - name_map: {lowercased name: (id, name)} (first occurrence wins)
+      - search_list: [(lowercased name, id, name), ...] in service order
+    """
     layers = service_info.get("layers") or []
+
+    id_map, name_map, search_list = {}, {}, []
+    for L in layers:
+        try:
+            lid = int(L.get("id"))
+        except (TypeError, ValueError):
+            continue
+        name = L.get("name")
+        lname = (name or "").strip().lower()
+        id_map.setdefault(lid, (lid, name))
+        name_map.setdefault(lname, (lid, name))
+        search_list.append((lname, lid, name))
+
+    return id_map, name_map, search_list
+
+
+def _resolve_layer(service_info: Mapping, layer_identifier: str, json_url: str) -> Tuple[int, Optional[str]]:
+    layers = service_info.get("layers")
     if not layers:
         raise ValueError("Service does not advertise any 'layers'.")
+    hit = _REST_CACHE.get(json_url)
+    # the read-only view hands out the cached JSON's own 'layers' list
+    if hit is not None and hit[1].get("layers") is layers:
+        id_map, name_map, search_list = hit[2]
+    else:  # entry expired or was cleared since the listing
+        id_map, name_map, search_list = _layer_index(service_info)
 
     # numeric id?
     if isinstance(layer_identifier, int) or (isinstance(layer_identifier, str) and layer_identifier.isdigit()):
-        lid = int(layer_identifier)
-        for L in layers:
-            if int(L.get("id")) == lid:
-                return lid, L.get("name")
-        raise ValueError(f"Layer id '{layer_identifier}' not found.")
+        hit = id_map.get(int(layer_identifier))
+        if hit is None:
+            raise ValueError(f"Layer id '{layer_identifier}' not found.")
+        return hit
 
     # by name (ci)
     needle = (layer_identifier or "").strip().lower()
-    for L in layers:
-        if (L.get("name") or "").strip().lower() == needle:
-            return int(L.get("id")), L.get("name")
-    for L in layers:
-        if needle and needle in (L.get("name") or "").strip().lower():
-            return int(L.get("id")), L.get("name")
+    hit = name_map.get(needle)
+    if hit is not None:
+        return hit
+    if needle:
+        for lname, lid, name in search_list:
+            if needle in lname:
+                return lid, name
 
     raise ValueError(f"Layer '{layer_identifier}' not found by name.")
 
 
-def _parse_supported_formats(fmt_str: str) -> List[str]:
+@lru_cache(maxsize=64)
+def _parse_supported_formats(fmt_str: str) -> Tuple[Tuple[str, ...], FrozenSet[str]]:
     """
-    Normalize ArcGIS 'supportedImageFormatTypes' into a list (lower-case tokens).
+    Normalize ArcGIS 'supportedImageFormatTypes' into (tuple of lower-case tokens in
+    service order, frozenset of the same tokens for membership tests).
     Example input: 'PNG32, PNG24, PNG8, JPG, BIL, BMP, GIF, TIFF'
+    Cached per string, so listing and every Add of the same service share one pair.
     """
-    tokens = [t.strip().lower() for t in (fmt_str or "").split(",") if t.strip()]
-    return tokens
+    available = tuple(t.strip().lower() for t in (fmt_str or "").split(",") if t.strip())
+    return available, frozenset(available)
 
 
-def _prefer_arcgis_format(requested_fmt: Optional[str], available: List[str]) -> str:
+def _prefer_arcgis_format(
+    requested_fmt: Optional[str], available: Tuple[str, ...], available_set: FrozenSet[str],
+) -> str:
     """
     Choose a good image format for MapServer export.
     Priority: requested -> png32 -> png24 -> png8 -> png -> jpg/jpeg -> first/PNG32.
+    'available' / 'available_set' are the pair memoised by _parse_supported_formats.
     """
     if requested_fmt:
-        r = requested_fmt.strip().lower()
-        if r in available:
+        r = requested_fmt.strip()
+        if not r.islower():
+            r = r.lower()
+        if r in available_set:
             return r
 
-    prefs = ["png32", "png24", "png8", "png", "jpg", "jpeg"]
-    for p in prefs:
-        if p in available:
+    for p in _FORMAT_PREFS:
+        if p in available_set:
             return p
 
     return available[0] if available else "png32"
@@ -1,22 +1,125 @@
 
+from collections.abc import Mapping
+from functools import lru_cache
+
 from PyQt5 import QtCore, QtGui, QtWidgets
 
+from .caps_utils import epsg_authid
 
-try:
-    from .catalog import CATALOG as _CATALOG
-    _HAS_STRUCTURED = True
-except Exception:
+
+@lru_cache(maxsize=None)
+def _build_catalog():
+    """Nested {country: {region: {"type", "url"}}} view of a legacy COUNTRY_WMS catalog."""
     from .catalog import COUNTRY_WMS as _LEGACY_COUNTRY_WMS
 
-    _CATALOG = {
+    return {
         country: {
             region: {"type": "WMS", "url": url}
-            for region, url in (regions.items() if isinstance(regions, dict) else {"All": regions}.items())
+            for region, url in (regions.items() if isinstance(regions, Mapping) else {"All": regions}.items())
         }
         for country, regions in _LEGACY_COUNTRY_WMS.items()
     }
+
+
+try:
+    from .catalog import CATALOG as _CATALOG
+    _HAS_STRUCTURED = True
+except Exception:
+    _CATALOG = _build_catalog()
     _HAS_STRUCTURED = False
 
+# Sorted once per process instead of on every country change
+_COUNTRY_NAMES = sorted(_CATALOG.keys())
+_SORTED_REGIONS = {c: sorted(rs.keys()) or ["All"] for c, rs in _CATALOG.items()}
+
+try:
+    from .catalog import prefix_search as _prefix_search
+except Exception:
+    _prefix_search = None
+
+
+class LayerListModel(QtCore.QAbstractItemModel):
+    """
+    Flat, checkable two-column layer list backed by plain Python tuples, so rows
+    cost no QTreeWidgetItem/QVariant each and the view only asks for visible ones.
+
+    Row: (name, detail, url, payload, service_info). data() serves the last three
+    under Qt.UserRole, Qt.UserRole + 1 and Qt.UserRole + 2.
+    """
+
+    HEADERS = ("Layer Name / Identifier", "Title")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []
+        self._checked = []
+
+    def set_rows(self, rows):
+        """Replace all rows in one model reset; every row starts unchecked."""
+        self.beginResetModel()
+        self._rows = list(rows)
+        self._checked = [False] * len(self._rows)
+        self.endResetModel()
+
+    def clear(self):
+        self.set_rows([])
+
+    def checked_rows(self):
+        return [row for row, checked in zip(self._rows, self._checked) if checked]
+
+    def rows(self):
+        return self._rows
+
+    # --- QAbstractItemModel ---
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if parent.isValid() or not (0 <= row < len(self._rows)) or not (0 <= column < 2):
+            return QtCore.QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=None):
+        if index is None:  # QObject.parent() overload
+            return super().parent()
+        return QtCore.QModelIndex()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 2
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        r, col = index.row(), index.column()
+        if role == QtCore.Qt.DisplayRole:
+            return self._rows[r][col]
+        if role == QtCore.Qt.CheckStateRole and col == 0:
+            return QtCore.Qt.Checked if self._checked[r] else QtCore.Qt.Unchecked
+        if QtCore.Qt.UserRole <= role <= QtCore.Qt.UserRole + 2:
+            return self._rows[r][2 + role - QtCore.Qt.UserRole]
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if role != QtCore.Qt.CheckStateRole or not index.isValid() or index.column() != 0:
+            return False
+        self._checked[index.row()] = (value == QtCore.Qt.Checked)
+        self.dataChanged.emit(index, index, [role])
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            return QtCore.Qt.NoItemFlags
+        flags = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        if index.column() == 0:
+            flags |= QtCore.Qt.ItemIsUserCheckable
+        return flags
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
 
 class EuropeOrthoDialog(QtWidgets.QDialog):
     def __init__(self, parent=None):
@@ -24,14 +127,22 @@ class EuropeOrthoDialog(QtWidgets.QDialog):
         self.setWindowTitle("EuropeOrthoViewer")
         self.setWindowIcon(QtGui.QIcon(":/resources/GIS.png"))
         self.resize(800, 540)
+        self._busy = False
 
         v = QtWidgets.QVBoxLayout(self)
 
-        # --- Top row: Country + Region + URL + List Layers ---
+        # --- Top row: Search + Country + Region + URL + List Layers ---
         row = QtWidgets.QHBoxLayout()
 
+        self.searchEdit = QtWidgets.QLineEdit()
+        self.searchEdit.setPlaceholderText("Search country / region")
+        self.searchEdit.setClearButtonEnabled(True)
+        self.searchEdit.setFixedWidth(170)
+        self.searchEdit.setVisible(_prefix_search is not None)
+        self.searchEdit.textChanged.connect(self._on_search_changed)
+
         self.countryCombo = QtWidgets.QComboBox()
-        self.countryCombo.addItems(sorted(_CATALOG.keys()))
+        self.countryCombo.addItems(_COUNTRY_NAMES)
         self.countryCombo.currentIndexChanged.connect(self._on_country_changed)
 
         self.regionCombo = QtWidgets.QComboBox()
@@ -40,7 +151,14 @@ class EuropeOrthoDialog(QtWidgets.QDialog):
 
         self.urlEdit = QtWidgets.QLineEdit()
         self.listBtn = QtWidgets.QPushButton("List Layers")
+        self.refreshBtn = QtWidgets.QPushButton("Refresh")
+        self.refreshBtn.setToolTip("Forget cached capabilities and list the layers again")
+        self.cancelBtn = QtWidgets.QPushButton("Cancel")
+        self.cancelBtn.setToolTip("Stop downloading the service capabilities")
+        self.cancelBtn.hide()
 
+        row.addWidget(self.searchEdit)
+        row.addSpacing(8)
         row.addWidget(QtWidgets.QLabel("Country:"))
         row.addWidget(self.countryCombo)
         row.addSpacing(8)
@@ -50,6 +168,8 @@ class EuropeOrthoDialog(QtWidgets.QDialog):
         row.addWidget(QtWidgets.QLabel("Service URL:"))
         row.addWidget(self.urlEdit, 1)
         row.addWidget(self.listBtn)
+        row.addWidget(self.refreshBtn)
+        row.addWidget(self.cancelBtn)
         v.addLayout(row)
 
         # --- Options row: CRS + format ---
@@ -72,9 +192,12 @@ class EuropeOrthoDialog(QtWidgets.QDialog):
         opt.addStretch(1)
         v.addLayout(opt)
 
-        # --- Layers tree ---
-        self.tree = QtWidgets.QTreeWidget()
-        self.tree.setHeaderLabels(["Layer Name / Identifier", "Title"])
+        # --- Layers list ---
+        self.layerModel = LayerListModel(self)
+        self.tree = QtWidgets.QTreeView()
+        self.tree.setModel(self.layerModel)
+        self.tree.setRootIsDecorated(False)
+        self.tree.setUniformRowHeights(True)
         v.addWidget(self.tree, 1)
 
         # --- Bottom buttons ---
@@ -96,10 +219,9 @@ class EuropeOrthoDialog(QtWidgets.QDialog):
     def _on_country_changed(self):
         """Update region list based on selected country."""
         country = self.countryCombo.currentText()
-        regions = _CATALOG.get(country, {})
 
         self.regionCombo.clear()
-        self.regionCombo.addItems(sorted(regions.keys()) or ["All"])
+        self.regionCombo.addItems(_SORTED_REGIONS.get(country, ["All"]))
         self._on_region_changed()
 
     def _on_region_changed(self):
@@ -109,16 +231,46 @@ class EuropeOrthoDialog(QtWidgets.QDialog):
 
         entry = _CATALOG.get(country, {}).get(region)
         url = ""
-        if isinstance(entry, dict):
-            url = entry.get("url", "")
-        elif isinstance(entry, str):
+        if isinstance(entry, str):
             url = entry
+        elif entry is not None:  # catalog Entry or legacy dict
+            url = entry.get("url", "")
 
         self.urlEdit.setText(url)
 
+    def _on_search_changed(self, text: str):
+        """Jump the country/region combos to the first catalog match for the typed prefix."""
+        text = text.strip()
+        if not text or _prefix_search is None:
+            return
+        matches = _prefix_search(text, limit=1)
+        if not matches:
+            return
+        country, region = matches[0]
+        idx = self.countryCombo.findText(country)
+        if idx < 0:
+            return
+        self.countryCombo.setCurrentIndex(idx)
+        ridx = self.regionCombo.findText(region)
+        if ridx >= 0:
+            self.regionCombo.setCurrentIndex(ridx)
+
     def currentCatalogSelection(self):
         return self.countryCombo.currentText(), self.regionCombo.currentText()
 
+    def set_busy(self, busy: bool):
+        """Toggle the 'downloading capabilities' state of the top row."""
+        if busy == self._busy:
+            return
+        self._busy = busy
+        self.listBtn.setEnabled(not busy)
+        self.refreshBtn.setEnabled(not busy)
+        self.cancelBtn.setVisible(busy)
+        if busy:
+            QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.BusyCursor)
+        else:
+            QtWidgets.QApplication.restoreOverrideCursor()
+
     # ----------------- CRS handling -----------------
 
     def _on_select_crs(self):
@@ -142,40 +294,25 @@ class EuropeOrthoDialog(QtWidgets.QDialog):
         if ok and crs:
             self.crsLabel.setText(crs)
 
-    def _normalize_epsg(self, s: str) -> str:
-        """Best-effort: convert OGC URN to EPSG:XXXX."""
-        if not s:
-            return ""
-        t = s.strip()
-        if t.upper().startswith("EPSG:"):
-            return t.upper()
-        if "epsg" in t.lower():
-            parts = t.replace("::", ":").split(":")
-            for token in reversed(parts):
-                if token.isdigit():
-                    return f"EPSG:{token}"
-        return ""
-
     def get_all_supported_crs(self):
         """
         Collect CRS codes from currently listed layers.
 
         WMS layout (your wms_utils):
-          - Qt.UserRole + 1 holds a list of CRS strings (e.g., ["EPSG:3857", "EPSG:4326", ...])
+          - the row payload is a list of CRS strings (e.g., ["EPSG:3857", "EPSG:4326", ...])
 
         WMTS layout (our wmts_utils):
-          - Qt.UserRole + 1 holds a dict payload containing "matrix_sets": [{"id": "...", "crs": "..."}]
+          - the row payload is a dict containing "matrix_sets": [{"id": "...", "crs": "..."}]
         """
         crs_set = set()
-        for i in range(self.tree.topLevelItemCount()):
-            it = self.tree.topLevelItem(i)
-            payload = it.data(0, QtCore.Qt.UserRole + 1)
+        for row in self.layerModel.rows():
+            payload = row[3]
 
             # WMS case: list of CRS strings
             if isinstance(payload, list):
                 for crs in payload:
                     if isinstance(crs, str):
-                        norm = self._normalize_epsg(crs) or (crs if crs.startswith("EPSG:") else "")
+                        norm = epsg_authid(crs) or (crs if crs.startswith("EPSG:") else "")
                         if norm:
                             crs_set.add(norm)
 
@@ -183,7 +320,7 @@ class EuropeOrthoDialog(QtWidgets.QDialog):
             elif isinstance(payload, dict):
                 msets = payload.get("matrix_sets") or []
                 for ms in msets:
-                    crs = self._normalize_epsg(ms.get("crs", ""))
+                    crs = epsg_authid(ms.get("crs", ""))
                     if crs:
                         crs_set.add(crs)
 
@@ -199,32 +336,21 @@ class EuropeOrthoDialog(QtWidgets.QDialog):
 
     def populate_layers(self, layers):
         """layers: list of dicts with keys name, title, crs_list."""
-        self.tree.clear()
-        for lyr in layers:
-            item = QtWidgets.QTreeWidgetItem([lyr["name"], lyr.get("title", lyr["name"])])
-            item.setCheckState(0, QtCore.Qt.Unchecked)
-            item.setData(0, QtCore.Qt.UserRole + 1, lyr.get("crs_list", []))
-            self.tree.addTopLevelItem(item)
+        self.layerModel.set_rows([
+            (lyr["name"], lyr.get("title", lyr["name"]), None, lyr.get("crs_list", []), None)
+            for lyr in layers
+        ])
 
     # ----------------- Selection helpers -----------------
 
     def selected_layer_names(self):
         """Legacy: return only names of checked items (works for WMS & WMTS)."""
-        names = []
-        for i in range(self.tree.topLevelItemCount()):
-            it = self.tree.topLevelItem(i)
-            if it.checkState(0) == QtCore.Qt.Checked:
-                names.append(it.text(0))
-        return names
+        return [row[0] for row in self.layerModel.checked_rows()]
 
     def selected_items(self):
         """
-        Preferred by main.py when available: return the actual checked items,
-        so add handlers can read per-item data (like cleaned base URL).
+        Preferred by main.py when available: return the checked rows
+        (name, detail, url, payload, service_info), so add handlers can read
+        per-layer data (like cleaned base URL) without touching the view.
         """
-        items = []
-        for i in range(self.tree.topLevelItemCount()):
-            it = self.tree.topLevelItem(i)
-            if it.checkState(0) == QtCore.Qt.Checked:
-                items.append(it)
-        return items
+        return self.layerModel.checked_rows()
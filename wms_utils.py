@@ -1,15 +1,20 @@
 
-from xml.etree import ElementTree as ET
-from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from functools import lru_cache
+from urllib.parse import quote, urlsplit, urlunsplit, parse_qsl, urlencode
 
 from qgis.core import QgsRasterLayer, QgsProject
-from PyQt5.QtWidgets import QTreeWidgetItem, QMessageBox
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QMessageBox
 
-from .net_utils import http_get_bytes  
+from .caps_utils import ET, CapsCache, epsg_authid, stream_parse
 
-NS_WMS = "{http://www.opengis.net/wms}"
 NS_XLINK = "{http://www.w3.org/1999/xlink}"
+_XLINK_HREF = NS_XLINK + "href"
+
+_CAPS_TTL_S = 120
+_WMS_VERSIONS = ("1.3.0", "1.1.1")
+
+# (wms_link, version) -> (parsed layers, GetMap base URL)
+_CAPS_CACHE = CapsCache(_CAPS_TTL_S)
 
 
 def clean_url(url: str) -> str:
@@ -44,206 +49,248 @@ def _normalize_service_base(url: str) -> str:
     return urlunsplit(parts)
 
 
-# -------------------- Namespace-agnostic XML helpers -------------------- #
+# -------------------- Parsed capabilities cache -------------------- #
 
-def _findall_any(elem: ET.Element, localname: str):
-    """
-    Namespace-agnostic findall for a given local tag name.
-    Works for WMS 1.3.0 (namespaced) and 1.1.1 (often no namespace).
-    """
-    return elem.findall(f"{'{*}'}{localname}") + elem.findall(localname)
+def clear_caches():
+    """Drop all cached capabilities (bound to the dialog's Refresh button)."""
+    _CAPS_CACHE.clear()
 
 
-def _first_any(elem: ET.Element, localname: str):
-    """Namespace-agnostic find for the first occurrence of a tag."""
-    res = elem.find(f"{'{*}'}{localname}")
-    return res if res is not None else elem.find(localname)
+def is_cached(wms_link):
+    """True if load_wms_layers can answer from memory without any request."""
+    wms_link = clean_url(wms_link)
+    return any(_CAPS_CACHE.get((wms_link, ver)) is not None for ver in _WMS_VERSIONS)
 
 
 # -------------------- Capabilities parsing (layers/CRS) -------------------- #
 
-def _parse_layers_from_caps(xml_bytes: bytes):
+def _normalize_crs_tokens(text: str):
     """
-    Parses WMS GetCapabilities XML recursively and accumulates inherited CRS/SRS.
-    Returns a list of dicts: {name: ..., title: ..., crs_list: [...]}
-    - Supports WMS 1.3.0 (CRS) and 1.1.1 (SRS), with or without namespaces.
+    SRS/CRS elements in 1.1.1 can contain multiple codes separated by spaces/commas.
+    Return individual tokens.
     """
-    def normalize_crs_tokens(text: str):
-        """
-        SRS/CRS elements in 1.1.1 can contain multiple codes separated by spaces/commas.
-        Yield individual tokens.
-        """
-        if not text:
-            return []
-        tokens = []
-        for chunk in text.replace(",", " ").split():
-            if chunk:
-                tokens.append(chunk.strip())
-        return tokens
-
-    def walk_layers(elem: ET.Element, inherited_crs: list):
-        layers = []
-
-        # Collect this element's CRS/SRS entries (support both tags)
-        own_crs = []
-        for e in _findall_any(elem, "CRS"):
-            own_crs.extend(normalize_crs_tokens(e.text or ""))
-        for e in _findall_any(elem, "SRS"):
-            own_crs.extend(normalize_crs_tokens(e.text or ""))
-
-        combined_crs = inherited_crs + own_crs
-
-        name_el = _first_any(elem, "Name")
-        title_el = _first_any(elem, "Title")
-
-        # If this is a named (leaf) layer, store it
-        if name_el is not None and (name_el.text or "").strip():
-            normalized_crs = []
-            for crs in combined_crs:
-                if not crs:
-                    continue
-                cs = crs.strip()
-                up = cs.upper()
-                if up.startswith("EPSG:"):
-                    normalized_crs.append(up)
-                elif "EPSG" in up:
-                    # handle URN/OGC forms like "urn:ogc:def:crs:EPSG::3857"
-                    parts = cs.replace("::", ":").split(":")
-                    for token in reversed(parts):
-                        if token.isdigit():
-                            normalized_crs.append(f"EPSG:{token}")
-                            break
-
-            layers.append({
-                "name": name_el.text.strip(),
-                "title": (title_el.text.strip() if (title_el is not None and title_el.text) else name_el.text.strip()),
-                "crs_list": sorted(set(normalized_crs))
-            })
+    if not text:
+        return []
+    return text.replace(",", " ").split()
 
-        for child in _findall_any(elem, "Layer"):
-            if child is elem:
-                continue
-            layers += walk_layers(child, combined_crs)
 
-        return layers
+def _normalize_crs(codes):
+    """Map raw CRS codes to 'EPSG:nnnn', dropping non-EPSG ones (e.g. CRS:84)."""
+    normalized_crs = []
+    for crs in codes:
+        authid = epsg_authid(crs)
+        if authid:
+            normalized_crs.append(authid)
+    return normalized_crs
 
-    root = ET.fromstring(xml_bytes)
 
-    # Try capability root, then fallback to first Layer anywhere
-    root_layer = None
-    cap = _first_any(root, "Capability")
-    if cap is not None:
-        root_layer = _first_any(cap, "Layer")
-    if root_layer is None:
-        root_layer = _first_any(root, "Layer")
-    if root_layer is None:
-        return []
+class _LayerBuilder:
+    """
+    XMLParser target for WMS GetCapabilities: no tree is built at all.
+    Keeps a stack of open Layer frames (inherited CRS + own Name/Title) and
+    collects named layers in document order; close() returns them.
+    CRS sets are normalized once per CRS/SRS element and inherited as frozensets;
+    layers with the same effective set share one sorted crs_list object.
+    Also picks up the advertised Request/GetMap/DCPType/HTTP/Get/OnlineResource
+    href on the way (self.getmap_href, "" if absent).
+    """
 
-    all_layers = walk_layers(root_layer, [])
+    def __init__(self):
+        self.layers = []
+        self.getmap_href = None
+        self._path = []    # local tag names of the open elements
+        self._frames = []  # open Layer frames, innermost last
+        self._text = []
+        self._have_root = False
+        self._sorted_crs = {}  # frozenset -> sorted list, shared between layers
+
+    def _emit(self, frame):
+        frame["emitted"] = True
+        name = frame["name"]
+        if name:
+            crs = frame["crs"]
+            crs_list = self._sorted_crs.get(crs)
+            if crs_list is None:
+                crs_list = self._sorted_crs[crs] = sorted(crs)
+            self.layers.append({
+                "name": name,
+                "title": frame["title"] or name,
+                "crs_list": crs_list,
+            })
 
+    def start(self, tag, attrib):
+        tag = tag.rpartition("}")[2]
+        path, frames = self._path, self._frames
+        self._text = []
+        if tag == "OnlineResource":
+            if (self.getmap_href is None and len(path) >= 5 and path[-1] == "Get"
+                    and path[-2] == "HTTP" and path[-3] in ("DCPType", "DCP")
+                    and path[-4] == "GetMap" and path[-5] == "Request"):
+                self.getmap_href = (attrib.get(_XLINK_HREF) or attrib.get("href") or "").strip()
+        elif tag == "Layer":
+            if frames and path and path[-1] == "Layer" and frames[-1]["depth"] == len(path):
+                # nested layer: the parent's own fields are complete, emit it first
+                top = frames[-1]
+                if not top["emitted"]:
+                    self._emit(top)
+                inherited = top["crs"]
+            elif not self._have_root:
+                self._have_root = True
+                inherited = frozenset()
+            else:
+                inherited = None
+            if inherited is not None:
+                frames.append({
+                    "crs": inherited, "name": None, "title": None,
+                    "emitted": False, "depth": len(path) + 1,
+                })
+        path.append(tag)
+
+    def data(self, data):
+        self._text.append(data)
+
+    def end(self, tag):
+        tag = tag.rpartition("}")[2]
+        path, frames = self._path, self._frames
+        path.pop()
+        if not frames:
+            return
+        top = frames[-1]
+        if tag == "Layer" and top["depth"] == len(path) + 1:
+            frames.pop()
+            if not top["emitted"]:
+                self._emit(top)
+        elif top["depth"] == len(path):
+            # direct child of the innermost Layer (skips Style/Name etc.)
+            if tag == "CRS" or tag == "SRS":
+                own = _normalize_crs(_normalize_crs_tokens("".join(self._text)))
+                if own and not top["crs"].issuperset(own):
+                    top["crs"] = top["crs"].union(own)
+            elif tag == "Name" and top["name"] is None:
+                top["name"] = "".join(self._text).strip()
+            elif tag == "Title" and top["title"] is None:
+                top["title"] = "".join(self._text).strip()
+        self._text = []
+
+    def close(self):
+        if self.getmap_href is None:
+            self.getmap_href = ""
+        return self.layers
+
+
+def _dedupe_layers(layers):
     seen, uniq = set(), []
-    for d in all_layers:
+    for d in layers:
         if d["name"] not in seen:
             uniq.append(d)
             seen.add(d["name"])
-
     return uniq
 
 
-# -------------------- Capabilities parsing (GetMap URL) -------------------- #
-
-def _extract_getmap_base(xml_bytes: bytes) -> str:
-    """
-    Parse Capabilities for the Request->GetMap->DCPType/HTTP->Get->OnlineResource@xlink:href.
-    Return the href (including any query params). Fallback to empty string if not found.
-    Namespace-agnostic and tolerant to 'DCP' vs 'DCPType'.
-    """
-    root = ET.fromstring(xml_bytes)
-
-    cap = _first_any(root, "Capability")
-    if cap is None:
-        cap = root
-
-    req = _first_any(cap, "Request")
-    if req is None:
-        return ""
-
-    getmap = _first_any(req, "GetMap")
-    if getmap is None:
-        return ""
+def _stream_caps(caps_url: str, cancelled=None, force_refresh=False):
+    """Returns (layers, advertised GetMap href or "", final caps URL); see stream_parse."""
+    builder = _LayerBuilder()
+    layers, final_url = stream_parse(caps_url, builder, cancelled, force_refresh)
+    return _dedupe_layers(layers), builder.getmap_href, final_url
 
-    dcp = _first_any(getmap, "DCPType")
-    if dcp is None:
-        dcp = _first_any(getmap, "DCP")
-    if dcp is None:
-        return ""
-
-    http = _first_any(dcp, "HTTP")
-    if http is None:
-        return ""
-
-    get = _first_any(http, "Get")
-    if get is None:
-        return ""
-
-    or_el = _first_any(get, "OnlineResource")
-    if or_el is None:
-        return ""
-
-    href = or_el.get(NS_XLINK + "href") or or_el.get("href") or ""
-    return href.strip()
 
+# ------------------------------ Public API ------------------------------ #
 
+def get_capabilities_url(wms_link, version="1.3.0"):
+    """GetCapabilities URL that load_wms_layers requests first (useful for prefetching)."""
+    return _build_caps_url(clean_url(wms_link), version)
 
-# ------------------------------ Public API ------------------------------ #
 
-def load_wms_layers(wms_link, tree_widget):
+def fetch_wms_layers(wms_link, cancelled=None, force_refresh=False):
     """
-    Fetch WMS capabilities and populate the tree widget with available layers.
-
-    Stores in each item:
-    - Qt.UserRole: base WMS URL (advertised GetMap href when available; else working caps URL)
-    - Qt.UserRole + 1: layer-supported CRS list
+    Fetch and parse WMS capabilities (1.3.0, then 1.1.1) without touching any widget,
+    so it can run on a worker thread. Parsed results are kept in memory for
+    _CAPS_TTL_S seconds per (link, version).
+    'cancelled' (optional callable) stops the download, see caps_utils.stream_parse;
+    force_refresh=True bypasses both the memory and the disk cache.
+
+    Returns (layers, base_url) where base_url is the advertised GetMap href when
+    available, else the working caps URL. Raises RuntimeError with the details.
     """
     wms_link = clean_url(wms_link)
     errors = []
 
-    for ver in ("1.3.0", "1.1.1"):
+    for ver in () if force_refresh else _WMS_VERSIONS:
+        cached = _CAPS_CACHE.get((wms_link, ver))
+        if cached is not None:
+            return cached
+
+    for ver in _WMS_VERSIONS:
         try:
             caps_url = _build_caps_url(wms_link, ver)
-            xml_bytes, used_caps_url = http_get_bytes(caps_url, timeout_ms=15000) 
 
-            # 1) Parse layers (namespace-agnostic; CRS+SRS)
-            layers = _parse_layers_from_caps(xml_bytes)
+            # 1) Parse layers while downloading (namespace-agnostic; CRS+SRS)
+            layers, advertised_getmap, used_caps_url = _stream_caps(caps_url, cancelled, force_refresh)
             if not layers:
                 errors.append(f"No layers found in capabilities (version {ver}).")
                 continue
 
             # 2) Prefer the server-advertised GetMap endpoint 
-            advertised_getmap = _extract_getmap_base(xml_bytes)
             base_url = _normalize_service_base(advertised_getmap or used_caps_url)
 
-            tree_widget.clear()
-            for lyr in layers:
-                item = QTreeWidgetItem([lyr["name"], lyr["title"]])
-                item.setCheckState(0, Qt.Unchecked)
-                item.setData(0, Qt.UserRole, base_url)
-                item.setData(0, Qt.UserRole + 1, lyr.get("crs_list", []))
-                tree_widget.addTopLevelItem(item)
-
-            return  
+            parsed = (layers, base_url)
+            _CAPS_CACHE.put((wms_link, ver), parsed)
+            return parsed
 
         except (ET.ParseError, RuntimeError) as e:
+            _CAPS_CACHE.pop((wms_link, ver))
+            if cancelled is not None and cancelled():
+                raise  # no point trying the next version
             errors.append(f"{ver}: {e}")
 
-    QMessageBox.critical(
-        None,
-        "WMS Error",
+    raise RuntimeError(
         "Failed to read WMS GetCapabilities from:\n"
         f"{wms_link}\n\nDetails:\n" + "\n".join(errors)
     )
 
 
+def load_wms_layers(wms_link, model, parsed=None):
+    """
+    Fill the dialog's layer list model with the layers of a WMS.
+
+    'parsed' is an optional fetch_wms_layers(wms_link) result, e.g. computed off the
+    UI thread; without it the capabilities are fetched here.
+
+    Each row is (name, title, url, crs_list, None):
+    - url: base WMS URL (advertised GetMap href when available; else working caps URL)
+    - crs_list: layer-supported CRS list
+    """
+    if parsed is None:
+        try:
+            parsed = fetch_wms_layers(wms_link)
+        except RuntimeError as e:
+            QMessageBox.critical(None, "WMS Error", str(e))
+            return
+    layers, base_url = parsed
+    model.set_rows([
+        (lyr["name"], lyr["title"], base_url, lyr.get("crs_list", []), None)
+        for lyr in layers
+    ])
+
+
+@lru_cache(maxsize=32)
+def _wms_uri_prefix(wms_link, crs, img_format):
+    """
+    Everything but 'layers=' of a QGIS WMS provider URI, percent-encoded (the provider
+    decodes each value, so '&' in the service URL or '?' query no longer splits it).
+    Cached, so a multi-layer "Add Selected" builds it once.
+    """
+    params = (
+        ("contextualWMSLegend", "0"),
+        ("crs", crs),
+        ("dpiMode", "7"),
+        ("format", img_format),
+        ("styles", ""),
+        ("url", wms_link),
+    )
+    return "&".join(f"{k}={quote(v, safe='')}" for k, v in params)
+
+
 def add_wms_layer(layer_name, wms_link, crs=None, img_format="image/jpeg"):
     """
     Add a WMS layer to the QGIS project using the chosen CRS and image format.
@@ -256,16 +303,7 @@ def add_wms_layer(layer_name, wms_link, crs=None, img_format="image/jpeg"):
     if not crs:
         crs = QgsProject.instance().crs().authid() or "EPSG:4326"
 
-    params = [
-        "contextualWMSLegend=0",
-        f"crs={crs}",
-        "dpiMode=7",
-        f"format={img_format}",
-        f"layers={layer_name}",
-        "styles=",
-        f"url={wms_link}",  
-    ]
-    uri = "&".join(params)
+    uri = f"{_wms_uri_prefix(wms_link, crs, img_format)}&layers={quote(layer_name, safe='')}"
 
     layer = QgsRasterLayer(uri, layer_name, "wms")
     if layer.isValid():
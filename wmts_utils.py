@@ -1,18 +1,62 @@
 
-from xml.etree import ElementTree as ET
-from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
-from typing import Dict, List, Optional
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from itertools import product
+from urllib.parse import quote, urlsplit, urlunsplit, parse_qsl, urlencode
+from typing import Callable, Dict, List, Optional, Tuple
 
 from qgis.core import QgsRasterLayer, QgsProject
-from PyQt5.QtWidgets import QTreeWidgetItem, QMessageBox
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QMessageBox
 
-from .net_utils import http_get_bytes  
+from .caps_utils import ET, CapsCache, epsg_authid, stream_parse
 
-NS = {
-    "wmts": "http://www.opengis.net/wmts/1.0",
-    "ows": "http://www.opengis.net/ows/1.1",
-    "xlink": "http://www.w3.org/1999/xlink",
+@dataclass
+class WMTSLayer:
+    """One advertised WMTS layer (slotted: hundreds of these live in the capabilities cache)."""
+    __slots__ = (
+        "identifier", "title", "formats", "matrix_sets", "styles",
+        "default_style", "default_format", "default_matrix_set",
+    )
+    identifier: str
+    title: str
+    formats: List[str]
+    matrix_sets: List[Dict]  # [{"id": str, "crs": Optional[str]}]
+    styles: List[str]
+    default_style: Optional[str]
+    default_format: Optional[str]
+    default_matrix_set: Optional[str]
+
+
+# Clark-notation tag names, exactly as the parser target receives them
+_Q_LAYER = "{http://www.opengis.net/wmts/1.0}Layer"
+_Q_FORMAT = "{http://www.opengis.net/wmts/1.0}Format"
+_Q_STYLE = "{http://www.opengis.net/wmts/1.0}Style"
+_Q_TMSLINK = "{http://www.opengis.net/wmts/1.0}TileMatrixSetLink"
+_Q_TMS_INNER = "{http://www.opengis.net/wmts/1.0}TileMatrixSet"  # inside TileMatrixSetLink
+_Q_TMS = _Q_TMS_INNER                                            # Contents/TileMatrixSet
+_Q_TILEMATRIX = "{http://www.opengis.net/wmts/1.0}TileMatrix"
+_Q_IDENT = "{http://www.opengis.net/ows/1.1}Identifier"
+_Q_TITLE = "{http://www.opengis.net/ows/1.1}Title"
+_Q_SUPPORTED_CRS = "{http://www.opengis.net/ows/1.1}SupportedCRS"
+_Q_OP = "{http://www.opengis.net/ows/1.1}Operation"
+_Q_DCP = "{http://www.opengis.net/ows/1.1}DCP"
+_Q_HTTP = "{http://www.opengis.net/ows/1.1}HTTP"
+_Q_GET = "{http://www.opengis.net/ows/1.1}Get"
+_XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+_CAPS_TTL_S = 120
+
+# GetCapabilities URL -> (fetch_wmts_layers result, _layer_index of its layers)
+_CAPS_CACHE = CapsCache(_CAPS_TTL_S)
+
+# _prefer_format ranks (lower is better); "image/jpgpng" is a pseudo format, used only
+# when nothing else is advertised
+_FMT_RANK_PNG_LIKE = 3
+_FMT_RANK_OTHER = 6
+_FMT_RANK_JPGPNG = 7
+_FORMAT_RANKS = {
+    "image/png": 0, "image/png8": 1, "image/png32": 2, "image/jpeg": 4, "image/jpg": 5,
+    "image/jpgpng": _FMT_RANK_JPGPNG,
 }
 
 
@@ -20,12 +64,16 @@ def _clean_url(url: str) -> str:
     return (url or "").strip()
 
 
+@lru_cache(maxsize=128)
 def _build_caps_url(base_url: str) -> str:
     """
     Build a WMTS GetCapabilities URL from any base WMTS link (KVP or REST base).
     If the link is already a KVP URL, we override SERVICE/REQUEST conservatively.
     """
-    parts = urlsplit(base_url.strip())
+    base_url = base_url.strip()
+    if "?" not in base_url and "#" not in base_url:
+        return base_url + "?SERVICE=WMTS&REQUEST=GetCapabilities"
+    parts = urlsplit(base_url)
     q = dict(parse_qsl(parts.query, keep_blank_values=True))
     q.update({
         "SERVICE": "WMTS",
@@ -35,6 +83,7 @@ def _build_caps_url(base_url: str) -> str:
     return urlunsplit(parts)
 
 
+@lru_cache(maxsize=128)
 def _normalize_service_base(url: str) -> str:
     """
     Return a clean base service URL to use in QGIS URI: keep existing params except
@@ -43,6 +92,8 @@ def _normalize_service_base(url: str) -> str:
     """
     if not url:
         return ""
+    if "?" not in url and "#" not in url:
+        return url
     parts = urlsplit(url)
     q = dict(parse_qsl(parts.query, keep_blank_values=True))
     for k in list(q.keys()):
@@ -52,336 +103,419 @@ def _normalize_service_base(url: str) -> str:
     return urlunsplit(parts)
 
 
-def _extract_gettile_base(xml_bytes: bytes) -> str:
-    """
-    From Capabilities, read OperationsMetadata/Operation name='GetTile'/DCP/HTTP/Get/@xlink:href.
-    Return the href (possibly with query params). Empty string if not found.
-    """
-    root = ET.fromstring(xml_bytes)
-    ops = root.find("ows:OperationsMetadata", NS)
-    if ops is None:
-        return ""
-    for op in ops.findall("ows:Operation", NS):
-        name = op.get("name") or ""
-        if name.lower() != "gettile":
-            continue
-        dcp = op.find("ows:DCP", NS)
-        if dcp is None:
-            continue
-        http = dcp.find("ows:HTTP", NS)
-        if http is None:
-            continue
-        get = http.find("ows:Get", NS)
-        if get is None:
-            continue
-        href = get.get(f"{{{NS['xlink']}}}href") or get.get("href") or ""
-        return href.strip()
-    return ""
-
-
-def _parse_tile_matrix_sets(root: ET.Element) -> Dict[str, Dict]:
-    """
-    Return { tms_id: {"crs": <str>, "count": <int>} }
-    """
-    out: Dict[str, Dict] = {}
-    contents = root.find("wmts:Contents", NS)
-    if contents is None:
-        return out
-
-    for tms in contents.findall("wmts:TileMatrixSet", NS):
-        id_el = tms.find("ows:Identifier", NS)
-        crs_el = tms.find("ows:SupportedCRS", NS)
-        if id_el is None:
-            continue
-        tms_id = (id_el.text or "").strip()
-        crs = (crs_el.text or "").strip() if crs_el is not None else None
-        count = len(tms.findall("wmts:TileMatrix", NS))
-        out[tms_id] = {"crs": crs, "count": count}
-    return out
-
-
 def _prefer_format(fmts: List[str]) -> Optional[str]:
     """
     Choose a concrete image format. Filter out pseudo/union tokens like 'image/jpgpng'.
     Preference: PNG (png, png8, png32) -> any png-like -> JPEG -> first remaining.
+    Single pass: each format is lowercased once and ranked; the first best rank wins.
     """
-    if not fmts:
-        return None
-
-    lower_pairs = [(f, f.lower()) for f in fmts if f]
-    filtered = [orig for (orig, low) in lower_pairs if low not in {"image/jpgpng"}]
-    candidates = filtered if filtered else [orig for (orig, _) in lower_pairs]
-
-    for pref in ("image/png", "image/png8", "image/png32"):
-        for c in candidates:
-            if c.lower() == pref:
-                return c
-
-    for c in candidates:
-        if "png" in c.lower():
-            return c
-
-    for pref in ("image/jpeg", "image/jpg"):
-        for c in candidates:
-            if c.lower() == pref:
-                return c
-
-    return candidates[0] if candidates else None
+    best = None
+    best_rank = _FMT_RANK_JPGPNG + 1
+    for f in fmts:
+        if not f:
+            continue
+        low = f.lower()
+        rank = _FORMAT_RANKS.get(low)
+        if rank is None:
+            rank = _FMT_RANK_PNG_LIKE if "png" in low else _FMT_RANK_OTHER
+        if rank == 0:
+            return f
+        if rank < best_rank:
+            best, best_rank = f, rank
+    return best
 
 
 def _prefer_matrix_set(sets: List[Dict]) -> Optional[str]:
-    if not sets:
-        return None
+    """Prefer a Web Mercator matrix set, then WGS84, then the first one (single pass)."""
+    best = None
+    best_rank = 3
+    for s in sets:
+        low = (s.get("crs") or "").lower()
+        nospace = low.replace(" ", "")
+        if "3857" in low or "900913" in low or "webmercator" in nospace:
+            return s["id"]
+        rank = 1 if ("4326" in low or "wgs84" in nospace) else 2
+        if rank < best_rank:
+            best, best_rank = s["id"], rank
+    return best
+
+
+def _new_layer(
+    identifier: str,
+    title: str,
+    fmts: List[str],
+    ms_links: List[Dict],
+    styles: List[str],
+    default_style: Optional[str]
+) -> WMTSLayer:
+    """Assemble a WMTSLayer; falls back to a 'default'/first style when none is flagged."""
+    if default_style is None and styles:
+        default_style = next((s for s in styles if s.lower() == "default"), styles[0])
+
+    return WMTSLayer(
+        identifier=identifier,
+        title=title,
+        formats=fmts,
+        matrix_sets=ms_links,
+        styles=styles,
+        default_style=default_style,
+        default_format=_prefer_format(fmts),
+        default_matrix_set=None,
+    )
 
-    def is_3857(crs: Optional[str]) -> bool:
-        s = (crs or "").lower().replace("::", ":")
-        return "3857" in s or "900913" in s or "webmercator" in s.replace(" ", "")
 
-    def is_4326(crs: Optional[str]) -> bool:
-        s = (crs or "").lower()
-        return "4326" in s or "wgs84" in s.replace(" ", "")
+def _link_matrix_sets(layers: List[WMTSLayer], tms_dict: Dict[str, Dict]) -> None:
+    """Fill each layer's matrix set CRS from tms_dict and pick its default matrix set."""
+    for lyr in layers:
+        for ms in lyr.matrix_sets:
+            ms["crs"] = tms_dict.get(ms["id"], {}).get("crs")
+        lyr.default_matrix_set = _prefer_matrix_set(lyr.matrix_sets)
 
-    for s in sets:
-        if is_3857(s.get("crs")):
-            return s["id"]
-    for s in sets:
-        if is_4326(s.get("crs")):
-            return s["id"]
-    return sets[0]["id"]
 
+# Style isDefault values meaning true, in every letter casing: _WMTSCapsTarget tests the
+# raw attribute with one set lookup, no .lower() per Style
+_TRUE_TOKENS = frozenset(
+    "".join(chars)
+    for word in ("true", "1", "yes")
+    for chars in product(*({c.lower(), c.upper()} for c in word))
+)
 
-def _to_qgis_authid(crs_str: Optional[str]) -> Optional[str]:
-    if not crs_str:
-        return None
-    s = crs_str.strip()
-    if s.upper().startswith("EPSG:"):
-        return s.upper()
-    if "epsg" in s.lower():
-        parts = s.replace("::", ":").split(":")
-        for token in reversed(parts):
-            if token.isdigit():
-                return f"EPSG:{token}"
-    return None
 
+class _WMTSCapsTarget:
+    """
+    XMLParser target for WMTS Capabilities: no Element is ever created.
+    Builds (tms_dict, layers, gettile_href) from start/data/end callbacks, taking
+    the first Identifier/Title/SupportedCRS of each element; close() returns that tuple.
+    State is the stack of open tags plus the Layer, Style or TileMatrixSet being
+    read; only their direct children (and Style/TileMatrixSetLink children) matter.
+    """
 
-def _parse_layers(root: ET.Element, tms_dict: Dict[str, Dict]) -> List[Dict]:
+    def __init__(self):
+        self.tms = {}
+        self.layers = []
+        self.gettile_href = None
+        self._path = []    # Clark tags of the open elements
+        self._text = []
+        self._layer = None  # fields of the open Layer
+        self._layer_depth = 0
+        self._style = None  # [identifier or None, isDefault] of the open Style
+        self._link_seen = False  # TileMatrixSet already read in the open TileMatrixSetLink
+        self._tms = None  # fields of the open Contents/TileMatrixSet
+        self._tms_depth = 0
+        self._in_gettile = False
+
+    def start(self, tag, attrib):
+        depth = len(self._path)
+        self._text = []
+        if self._layer is not None:
+            if depth == self._layer_depth + 1:
+                if tag == _Q_STYLE:
+                    self._style = [None, attrib.get("isDefault") in _TRUE_TOKENS]
+                elif tag == _Q_TMSLINK:
+                    self._link_seen = False
+        elif self._tms is not None:
+            pass
+        elif tag == _Q_LAYER:
+            self._layer = {
+                "identifier": None, "title": None, "formats": [], "matrix_sets": [],
+                "styles": [], "default_style": None,
+            }
+            self._layer_depth = depth
+        elif tag == _Q_TMS:
+            self._tms = {"id": None, "crs": None, "count": 0}
+            self._tms_depth = depth
+        elif tag == _Q_OP:
+            self._in_gettile = (attrib.get("name") or "").lower() == "gettile"
+        elif (tag == _Q_GET and self._in_gettile and self.gettile_href is None
+                and self._path[-2:] == [_Q_DCP, _Q_HTTP]):
+            self.gettile_href = (attrib.get(_XLINK_HREF) or attrib.get("href") or "").strip()
+        self._path.append(tag)
+
+    def data(self, data):
+        self._text.append(data)
+
+    def end(self, tag):
+        path = self._path
+        path.pop()
+        depth = len(path)
+        if self._layer is not None:
+            self._end_in_layer(tag, depth - self._layer_depth)
+        elif self._tms is not None:
+            entry = self._tms
+            rel = depth - self._tms_depth
+            if rel == 0:
+                if entry["id"] is not None:
+                    self.tms[entry["id"]] = {"crs": entry["crs"], "count": entry["count"]}
+                self._tms = None
+            elif rel == 1:
+                if tag == _Q_IDENT and entry["id"] is None:
+                    entry["id"] = "".join(self._text).strip()
+                elif tag == _Q_SUPPORTED_CRS and entry["crs"] is None:
+                    entry["crs"] = "".join(self._text).strip()
+                elif tag == _Q_TILEMATRIX:
+                    entry["count"] += 1
+        elif tag == _Q_OP:
+            self._in_gettile = False
+        self._text = []
+
+    def _end_in_layer(self, tag, rel):
+        L = self._layer
+        if rel == 0:
+            identifier = L["identifier"]
+            if identifier:
+                title = L["title"] if L["title"] is not None else identifier
+                self.layers.append(_new_layer(
+                    identifier, title, L["formats"], L["matrix_sets"],
+                    L["styles"], L["default_style"],
+                ))
+            self._layer = None
+        elif rel == 1:
+            if tag == _Q_IDENT:
+                if L["identifier"] is None:
+                    L["identifier"] = "".join(self._text).strip()
+            elif tag == _Q_TITLE:
+                if L["title"] is None:
+                    L["title"] = "".join(self._text).strip()
+            elif tag == _Q_FORMAT:
+                fmt = "".join(self._text).strip()
+                if fmt:
+                    L["formats"].append(fmt)
+            elif tag == _Q_STYLE and self._style is not None:
+                sid, is_def = self._style
+                if sid:
+                    L["styles"].append(sid)
+                    if is_def:
+                        L["default_style"] = sid
+                self._style = None
+        elif rel == 2:
+            parent = self._path[-1]
+            if parent == _Q_STYLE and tag == _Q_IDENT and self._style is not None:
+                if self._style[0] is None:
+                    self._style[0] = "".join(self._text).strip()
+            elif parent == _Q_TMSLINK and tag == _Q_TMS_INNER and not self._link_seen:
+                self._link_seen = True
+                ms_id = "".join(self._text).strip()
+                if ms_id:
+                    L["matrix_sets"].append({"id": ms_id, "crs": None})
+
+    def close(self):
+        _link_matrix_sets(self.layers, self.tms)
+        return self.tms, self.layers, self.gettile_href or ""
+
+
+def _stream_caps(
+    caps_url: str, cancelled: Optional[Callable[[], bool]] = None, force_refresh: bool = False,
+) -> Tuple[Dict[str, Dict], List[WMTSLayer], str, str]:
+    """Returns (tms_dict, layers, GetTile href or "", final caps URL); see stream_parse."""
+    (tms_dict, layers, gettile_href), final_url = stream_parse(caps_url, _WMTSCapsTarget(), cancelled, force_refresh)
+    return tms_dict, layers, gettile_href, final_url
+
+
+# -------------------- Parsed capabilities cache -------------------- #
+
+def _caps_cache_get(key):
+    hit = _CAPS_CACHE.get(key)
+    return hit[0] if hit is not None else None
+
+
+def _caps_cache_put(key, value):
+    _CAPS_CACHE.put(key, (value, _layer_index(value[0])))
+
+
+def _caps_layer_index(key, layers):
+    """Lookup tables cached with 'layers', rebuilt if that entry has expired meanwhile."""
+    hit = _CAPS_CACHE.get(key)
+    if hit is not None and hit[0][0] is layers:
+        return hit[1]
+    return _layer_index(layers)
+
+
+def clear_caches():
+    """Drop all cached capabilities (bound to the dialog's Refresh button)."""
+    _CAPS_CACHE.clear()
+
+
+def is_cached(wmts_link):
+    """True if load_wmts_layers can answer from memory without any request."""
+    return _caps_cache_get(_build_caps_url(_clean_url(wmts_link))) is not None
+
+
+def _layer_index(layers: List[WMTSLayer]) -> Tuple[Dict, Dict, Dict]:
     """
-    Return list of:
-      {
-        "identifier": str,
-        "title": Optional[str],
-        "formats": [str],
-        "matrix_sets": [{"id": str, "crs": Optional[str]}],
-        "styles": [str],
-        "default_style": Optional[str],
-        "default_format": Optional[str],
-        "default_matrix_set": Optional[str]
-      }
+    Lookup tables for a parsed layer list (first occurrence wins):
+      - by_ident: {identifier: layer}
+      - by_ident_ci: {lowercased identifier: layer}
+      - by_title_ci: {lowercased, stripped title: layer}
     """
-    out: List[Dict] = []
-    contents = root.find("wmts:Contents", NS)
-    if contents is None:
-        return out
-
-    for layer in contents.findall("wmts:Layer", NS):
-        ident_el = layer.find("ows:Identifier", NS)
-        if ident_el is None:
-            continue
-        identifier = (ident_el.text or "").strip()
-        if not identifier:
-            continue
+    by_ident, by_ident_ci, by_title_ci = {}, {}, {}
+    for L in layers:
+        by_ident.setdefault(L.identifier, L)
+        by_ident_ci.setdefault(L.identifier.lower(), L)
+        by_title_ci.setdefault((L.title or "").strip().lower(), L)
+    return by_ident, by_ident_ci, by_title_ci
 
-        title_el = layer.find("ows:Title", NS)
-        title = (title_el.text or "").strip() if title_el is not None else identifier
-
-        # Formats
-        fmts = [(f.text or "").strip() for f in layer.findall("wmts:Format", NS)]
-        fmts = [f for f in fmts if f]
-
-        # Matrix sets
-        ms_links = []
-        for link in layer.findall("wmts:TileMatrixSetLink", NS):
-            ms_el = link.find("wmts:TileMatrixSet", NS)
-            if ms_el is None:
-                continue
-            ms_id = (ms_el.text or "").strip()
-            if not ms_id:
-                continue
-            crs = tms_dict.get(ms_id, {}).get("crs")
-            ms_links.append({"id": ms_id, "crs": crs})
-
-        # Styles (detect isDefault="true" when present)
-        styles: List[str] = []
-        default_style: Optional[str] = None
-        for st in layer.findall("wmts:Style", NS):
-            sid_el = st.find("ows:Identifier", NS)
-            sid = (sid_el.text or "").strip() if sid_el is not None else ""
-            if not sid:
-                continue
-            styles.append(sid)
-            is_def = (st.get("isDefault") or "").lower() in {"true", "1", "yes"}
-            if is_def:
-                default_style = sid
-        if default_style is None:
-            if any(s.lower() == "default" for s in styles):
-                default_style = next(s for s in styles if s.lower() == "default")
-            elif styles:
-                default_style = styles[0]
-
-        out.append({
-            "identifier": identifier,
-            "title": title,
-            "formats": fmts,
-            "matrix_sets": ms_links,
-            "styles": styles,
-            "default_style": default_style,
-            "default_format": _prefer_format(fmts),
-            "default_matrix_set": _prefer_matrix_set(ms_links),
-        })
-    return out
 
+# ------------------------------- Public API ------------------------------- #
 
+def get_capabilities_url(wmts_link: str) -> str:
+    """GetCapabilities URL that load/add_wmts_layer request (useful for prefetching)."""
+    return _build_caps_url(_clean_url(wmts_link))
 
-# ------------------------------- Public API ------------------------------- #
 
-def load_wmts_layers(wmts_link: str, tree_widget) -> None:
+def fetch_wmts_layers(
+    wmts_link: str, cancelled: Optional[Callable[[], bool]] = None, force_refresh: bool = False,
+) -> Tuple[List[WMTSLayer], str, str]:
     """
-    Fetch WMTS capabilities and populate the tree with checkable items.
-    Stores in each item:
-      - Qt.UserRole: base WMTS URL (Capabilities-base; GetTile-base also saved in payload)
-      - Qt.UserRole + 1: dict payload with formats/matrix_sets/styles/defaults + bases
+    Fetch and parse WMTS capabilities without touching any widget, so it can run
+    on a worker thread.
+    Returns (layers, caps_base, tile_base); raises RuntimeError with the details.
+    Results are kept in memory for a short while, so add_wmts_layer and repeated
+    listings of the same service skip the download and parse.
+    'cancelled' (optional callable) stops the download, see caps_utils.stream_parse;
+    force_refresh=True bypasses both the memory and the disk cache.
     """
     wmts_link = _clean_url(wmts_link)
-    errors = []
-
     try:
         caps_url = _build_caps_url(wmts_link)
-        xml_bytes, used_caps_url = http_get_bytes(caps_url, timeout_ms=15000) 
-        root = ET.fromstring(xml_bytes)
+        cached = None if force_refresh else _caps_cache_get(caps_url)
+        if cached is not None:
+            return cached
 
-        tms_dict = _parse_tile_matrix_sets(root)
-        layers = _parse_layers(root, tms_dict)
+        _tms_dict, layers, gettile_href, used_caps_url = _stream_caps(caps_url, cancelled, force_refresh)
         if not layers:
             raise ValueError("No layers found in WMTS GetCapabilities.")
 
         caps_base = _normalize_service_base(used_caps_url)
-        tile_base = _normalize_service_base(_extract_gettile_base(xml_bytes))
-
-        tree_widget.clear()
-        for lyr in layers:
-            item = QTreeWidgetItem([lyr["identifier"], lyr["title"]])
-            item.setCheckState(0, Qt.Unchecked)
-            item.setData(0, Qt.UserRole, caps_base)
-            payload = {
-                "formats": lyr["formats"],
-                "matrix_sets": lyr["matrix_sets"],
-                "styles": lyr["styles"],
-                "default_style": lyr["default_style"],
-                "default_format": lyr["default_format"],
-                "default_matrix_set": lyr["default_matrix_set"],
-                "caps_base": caps_base,
-                "tile_base": tile_base,
-            }
-            item.setData(0, Qt.UserRole + 1, payload)
-            tree_widget.addTopLevelItem(item)
-        return
+        tile_base = _normalize_service_base(gettile_href)
+        parsed = (layers, caps_base, tile_base)
+        _caps_cache_put(caps_url, parsed)
+        return parsed
 
     except (ET.ParseError, ValueError, RuntimeError) as e:
-        errors.append(str(e))
+        raise RuntimeError(
+            "Failed to read WMTS GetCapabilities from:\n"
+            f"{wmts_link}\n\nDetails:\n{e}"
+        ) from e
 
-    QMessageBox.critical(
-        None,
-        "WMTS Error",
-        "Failed to read WMTS GetCapabilities from:\n"
-        f"{wmts_link}\n\nDetails:\n" + "\n".join(errors)
-    )
+
+def load_wmts_layers(
+    wmts_link: str,
+    model,
+    parsed: Optional[Tuple[List[WMTSLayer], str, str]] = None
+) -> None:
+    """
+    Fill the dialog's layer list model with the layers of a WMTS.
+    'parsed' is an optional fetch_wmts_layers(wmts_link) result, e.g. computed off
+    the UI thread; without it the capabilities are fetched here.
+    Each row is (identifier, title, url, payload, None):
+      - url: base WMTS URL (Capabilities-base; GetTile-base also saved in payload)
+      - payload: asdict() of the WMTSLayer + caps_base/tile_base, a plain dict for Qt
+        (add_wmts_layer accepts it as-is)
+    """
+    if parsed is None:
+        try:
+            parsed = fetch_wmts_layers(wmts_link)
+        except RuntimeError as e:
+            QMessageBox.critical(None, "WMTS Error", str(e))
+            return
+    layers, caps_base, tile_base = parsed
+
+    rows = []
+    for lyr in layers:
+        payload = asdict(lyr)
+        payload["caps_base"] = caps_base
+        payload["tile_base"] = tile_base
+        rows.append((lyr.identifier, lyr.title, caps_base, payload, None))
+    model.set_rows(rows)
 
 
 def add_wmts_layer(
     layer_identifier: str,
     wmts_link: str,
     matrix_set: Optional[str] = None,
-    fmt: Optional[str] = None
+    fmt: Optional[str] = None,
+    payload: Optional[Dict] = None
 ) -> None:
     """
     Add a WMTS layer to the current QGIS project.
     Strategy: build a correct WMTS URI and try with the Capabilities base first,
     then with the advertised GetTile base if the first attempt fails.
+    'payload' is the row payload stored by load_wmts_layers; with it no capabilities
+    are fetched at all, otherwise they come from fetch_wmts_layers (cached).
     """
     wmts_link = _clean_url(wmts_link)
 
     try:
-        caps_url = _build_caps_url(wmts_link)
-        xml_bytes, used_caps_url = http_get_bytes(caps_url, timeout_ms=15000)  # QGIS NAM
-        root = ET.fromstring(xml_bytes)
-
-        tms_dict = _parse_tile_matrix_sets(root)
-        layers = _parse_layers(root, tms_dict)
-
-        # Locate layer by Identifier (exact/ci) or Title (ci)
-        match = None
-        low = layer_identifier.strip().lower()
-        for L in layers:
-            if L["identifier"] == layer_identifier:
-                match = L
-                break
-        if match is None:
-            for L in layers:
-                if L["identifier"].lower() == low:
-                    match = L
-                    break
-        if match is None:
-            for L in layers:
-                if (L.get("title") or "").strip().lower() == low:
-                    match = L
-                    break
-        if match is None:
-            raise ValueError(f"WMTS layer '{layer_identifier}' not found in capabilities.")
-
-        chosen_ms = matrix_set or match["default_matrix_set"]
+        if payload is not None:
+            match = WMTSLayer(
+                identifier=layer_identifier,
+                title=payload.get("title"),
+                formats=payload.get("formats") or [],
+                matrix_sets=payload.get("matrix_sets") or [],
+                styles=payload.get("styles") or [],
+                default_style=payload.get("default_style"),
+                default_format=payload.get("default_format"),
+                default_matrix_set=payload.get("default_matrix_set"),
+            )
+            caps_base = payload.get("caps_base") or ""
+            tile_base = payload.get("tile_base") or ""
+        else:
+            layers, caps_base, tile_base = fetch_wmts_layers(wmts_link)
+
+            # Locate layer by Identifier (exact/ci) or Title (ci)
+            by_ident, by_ident_ci, by_title_ci = _caps_layer_index(_build_caps_url(wmts_link), layers)
+            low = layer_identifier.strip().lower()
+            match = by_ident.get(layer_identifier) or by_ident_ci.get(low) or by_title_ci.get(low)
+            if match is None:
+                raise ValueError(f"WMTS layer '{layer_identifier}' not found in capabilities.")
+
+        chosen_ms = matrix_set or match.default_matrix_set
         if not chosen_ms:
-            if match["matrix_sets"]:
-                chosen_ms = match["matrix_sets"][0]["id"]
+            if match.matrix_sets:
+                chosen_ms = match.matrix_sets[0]["id"]
             else:
-                raise ValueError(f"WMTS layer '{match['identifier']}' has no TileMatrixSet.")
+                raise ValueError(f"WMTS layer '{match.identifier}' has no TileMatrixSet.")
 
-        chosen_fmt = fmt or match["default_format"] or _prefer_format(match["formats"])
+        chosen_fmt = fmt or match.default_format or _prefer_format(match.formats)
         if not chosen_fmt:
-            raise ValueError(f"WMTS layer '{match['identifier']}' has no advertised image formats.")
+            raise ValueError(f"WMTS layer '{match.identifier}' has no advertised image formats.")
 
         # CRS comes from the chosen matrix set (optional in URI)
         crs_authid = None
-        for ms in match["matrix_sets"]:
+        for ms in match.matrix_sets:
             if ms["id"] == chosen_ms:
-                crs_authid = _to_qgis_authid(ms.get("crs"))
+                crs_authid = epsg_authid(ms.get("crs")) or None
                 break
 
         # Choose a valid style identifier
-        chosen_style = match.get("default_style") or (match.get("styles")[0] if match.get("styles") else "default")
-
-        # Base URLs: try Capabilities-base first, then GetTile-base
-        caps_base = _normalize_service_base(used_caps_url)
-        tile_base = _normalize_service_base(_extract_gettile_base(xml_bytes))
-        base_candidates = [b for b in [caps_base, tile_base] if b]
-
-        # Build common param list
-        common_params = [
-            "contextualWMSLegend=0",
-            f"layers={match['identifier']}",
-            f"styles={chosen_style}",
-            f"format={chosen_fmt}",
-            f"tileMatrixSet={chosen_ms}",
-        ]
+        chosen_style = match.default_style or (match.styles[0] if match.styles else "default")
+
+        # Base URLs: try Capabilities-base first, then GetTile-base (once if they are equal)
+        # (base URL, its quoted form for the url= slot)
+        base_candidates = [(b, quote(b, safe="")) for b in dict.fromkeys((caps_base, tile_base)) if b]
+
+        # One URI template per layer; values are percent-encoded (the provider decodes
+        # them), so '/', ';' or '&' in a format, style or matrix set cannot split the URI
+        ident_q = quote(match.identifier, safe="")
+        style_q = quote(chosen_style, safe="")
+        fmt_q = quote(chosen_fmt, safe="")
+        ms_q = quote(chosen_ms, safe="")
         if crs_authid:
-            common_params.insert(1, f"crs={crs_authid}")
-
-        display_name = match.get("title") or match["identifier"]
+            uri_tpl = (
+                f"contextualWMSLegend=0&crs={quote(crs_authid, safe='')}&layers={ident_q}"
+                f"&styles={style_q}&format={fmt_q}&tileMatrixSet={ms_q}&url={{base}}"
+            )
+        else:
+            uri_tpl = (
+                f"contextualWMSLegend=0&layers={ident_q}"
+                f"&styles={style_q}&format={fmt_q}&tileMatrixSet={ms_q}&url={{base}}"
+            )
+
+        display_name = match.title or match.identifier
 
         last_err = None
-        for base_url in base_candidates:
-            params = list(common_params)
-            params.append(f"url={base_url}")
-            uri = "&".join(params)
+        for base_url, base_q in base_candidates:
+            uri = uri_tpl.format(base=base_q)
             layer = QgsRasterLayer(uri, display_name, "wms")  # WMTS via 'wms' provider
             if layer.isValid():
                 QgsProject.instance().addMapLayer(layer)